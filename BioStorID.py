@@ -1,26 +1,63 @@
 #
-# This program pulls all BHL part ids and the corresponding BioStor ids from BHL.  It formats this information as a tsv file with two
-#  columns.  The file will be uploaded to a tab in Google Sheets and then the vlookup function will be used to add BioStor ids
-#  to another tab within the same spreadsheet. This code could be easily modified to return another identifier, e.g. TL-2 numbers.
+# This program pulls all BHL part ids and the corresponding BioStor ids from BHL.  It formats this information as a tsv file with
+#  the part id in the first column and the BioStor id in the second.  The file will be uploaded to a tab in Google Sheets and then
+#  the vlookup function will be used to add BioStor ids to another tab within the same spreadsheet. Other identifiers (DOI, TL-2,
+#  JSTOR, ...) and part fields (start page id, pages, date) are written to further columns from the same requests: list them in
+#  identifiers and part_fields below. The DOI is taken from the part's DOI identifier, or from its Doi field when there is none.
 #
 #  The user is prompted to enter the BHL title id.
 #  Sample function call in Google Sheets
 #  =VLOOKUP(A381,BioStor!A:B,2,false)
 #
+#  Item and part metadata are requested from BHL by a pool of worker threads. The number of workers is capped by max_workers below
+#  and the number of requests per second by bhl_client.max_rate. Rows are written to the tsv file in the same order as a one at a
+#  time crawl would write them, i.e. items in title order and parts in item order. Set max_workers to 1 for a one at a time crawl.
+#
+#  After each run the items, parts and identifiers found are saved in BioStor_state_<title id>.json with the time they were last
+#  seen. When this file exists the user is asked whether to refresh from it. A refresh fetches only the items that are new, whose
+#  BHL item record has changed or that were last checked more than item_recheck_days ago, and only the parts not already resolved
+#  (parts already saved with every identifier in required_ids, or saved without one less than part_recheck_days ago, are not fetched
+#  again). Parts saved before a column was added to identifiers or part_fields are fetched again. The full
+#  tsv file is written as usual, together with BioStor_delta.tsv listing the rows added, changed and removed since the last run.
+#
+#  The parts and their identifiers are also written to a local lookup store (bhl_store.sqlite, see bhl_store.py) unless store_file
+#  is set to the empty string. bhl_join.py adds the stored identifiers to a cr2bhl.py or toc_plmd.py tsv file, instead of VLOOKUP.
+#  Keep 'Start page id' in part_fields to join toc_plmd.py output, which is matched by start page id.
+#
+#  The BHL address may be changed with the BHL_URL environment variable and the request rate cap with BHL_MAX_RATE, e.g. to run
+#  against the local stub server in benchmarks/.
+#
 #  Load needed libraries
 #
+import os
 import urllib.parse
-import urllib.request
 import json
 import re
 import csv
+import time
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+import bhl_cache
+import bhl_stream
+import bhl_stats
+import bhl_files
+import bhl_store
 from config import BHL_key   # Use the BHL API key assigned to the person running the program
 #
 # Global variables
 #    
-service_url = 'https://www.biodiversitylibrary.org/api3?'
+service_url = os.environ.get('BHL_URL','https://www.biodiversitylibrary.org/') + 'api3?'
+max_workers = 8        # Maximum number of concurrent requests sent to BHL
+item_recheck_days = 28 # In a refresh, unchanged items are fetched again after this many days to look for new parts
+part_recheck_days = 28 # In a refresh, parts missing any of the required_ids are fetched again after this many days
+identifiers = ['BioStor', 'DOI', 'TL-2', 'JSTOR']  # Part identifiers written to the tsv file, by BHL IdentifierName. BioStor comes first.
+part_fields = {'Start page id': 'StartPageID', 'Pages': 'PageRange', 'Date': 'Date'}   # Further columns. Key is the column heading,
+                                                                                      # other field is the GetPartMetadata field.
+columns = identifiers + list(part_fields)   # Values saved for each part, in column order
+required_ids = identifiers[:1]              # Identifiers a part must have to be resolved. Other identifiers are optional.
+store_file = bhl_store.store_file          # Lookup store for bhl_join.py. Empty string: no store.
 #
-# Function definition
+# Function definitions
 #
 def get_input ():
     #
@@ -39,57 +76,191 @@ def opn_output():
     global fileh
     fileh = open('BioStor.tsv','w+',newline='', encoding='utf-8')
     writer = csv.writer(fileh, dialect='excel-tab')
-    writer.writerow(('BHL part id','BioStor id'))
+    writer.writerow(['BHL part id', identifiers[0] + ' id'] + columns[1:])
     return (writer)
+
+def ld_state(titleid):
+    #
+    #  Read the state saved by the last run for this title. Returns empty item and part dictionaries if there is none.
+    #
+    try:
+        with open('BioStor_state_'+titleid+'.json', encoding='utf-8') as fh:
+            state = json.load(fh)
+    except FileNotFoundError:
+        return {'items':{}, 'parts':{}}
+    for part in state['parts'].values():     # State saved before other identifiers were kept holds the BioStor id only
+        if 'ids' not in part:
+            part['ids'] = {'BioStor': part.pop('BioStor')}
+    return state
+
+def wrt_state(titleid, state):
+    #
+    #  Save the state for the next run
+    #
+    with bhl_files.replace_file('BioStor_state_'+titleid+'.json') as fh:
+        json.dump(state, fh)
+
+def wrt_delta(old_parts, rows):
+    #
+    #  Write the rows added, changed and removed since the last run to BioStor_delta.tsv
+    #
+    with open('BioStor_delta.tsv','w', newline='', encoding='utf-8') as fh:
+        writer = csv.writer(fh, dialect='excel-tab')
+        headings = [identifiers[0] + ' id'] + columns[1:]
+        writer.writerow(['Change','BHL part id'] + [text for heading in headings for text in (heading, 'Previous ' + heading)])
+        current = set()
+        for partID, values in rows:
+            current.add(str(partID))
+            old = old_parts.get(str(partID))
+            if old is None:
+                writer.writerow(['added',partID] + [text for col in columns for text in (values[col], '')])
+            elif any(old['ids'][col] != values[col] for col in columns if col in old['ids']):   # Columns new since the last run are not compared
+                writer.writerow(['changed',partID] + [text for col in columns for text in (values[col], old['ids'].get(col,''))])
+        for partID, old in old_parts.items():
+            if partID not in current:
+                writer.writerow(['removed',partID] + [text for col in columns for text in ('', old['ids'].get(col,''))])
+
+def item_sig(item):
+    #
+    #  Fingerprint of an item record from GetTitleMetadata. A different fingerprint means the item has changed.
+    #
+    return hashlib.sha1(json.dumps(item, sort_keys=True).encode('utf-8')).hexdigest()
+
+def call_api(params):
+    #
+    #  Call the BHL API, or use the cached response. Return the response text and the decoded json response.
+    #  In a refresh the cache is bypassed so that changes in BHL are seen.
+    #
+    url = service_url + urllib.parse.urlencode(dict(params, format='json', apikey=BHL_key))
+    #print(url)
+    mydata = bhl_cache.get_url(url, refresh=refresh)
+    return mydata, json.loads(mydata)
+
+def stream_api(params, path):
+    #
+    #  As call_api, for large responses. Return the records of the array at path, read one at a time as the response arrives.
+    #
+    url = service_url + urllib.parse.urlencode(dict(params, format='json', apikey=BHL_key))
+    return bhl_stream.open_records(url, path, refresh=refresh)
+
+def get_item_parts(itemid):
+    #
+    #  Return the part ids for one item. Runs in a worker thread.
+    #
+    parts = stream_api({'op':'GetItemMetadata','id':itemid,'parts':'t'}, ('Result', 0, 'Parts'))
+    if parts.fields.get('Status') != 'ok':
+        print('==== Failure to retrieve  parts ====')
+        print(parts.fields)
+        exit()
+    partids = [part['PartID'] for part in parts]   # Empty when the item has no parts
+    progress.step()
+    return partids
+
+def part_values(part):
+    #
+    #  Return the identifiers and fields of one part record from GetPartMetadata. Key is the column; missing values are ''.
+    #
+    values = dict.fromkeys(columns, '')
+    for identifier in part.get('Identifiers') or []:  # Check each identifier looking for the identifiers wanted
+        name = identifier['IdentifierName']
+        if name in identifiers and not values[name]:
+            values[name] = identifier['IdentifierValue']
+    if 'DOI' in values and not values['DOI']:
+        values['DOI'] = part.get('Doi') or ''
+    for heading, field in part_fields.items():
+        values[heading] = str(part.get(field) or '')
+    if 'Pages' in part_fields and not values['Pages'] and part.get('StartPageNumber'):   # No PageRange. Use the first and last page.
+        values['Pages'] = '-'.join(str(part[field]) for field in ('StartPageNumber','EndPageNumber') if part.get(field))
+    return values
+
+def get_part_ids(partid):
+    #
+    #  Return the part id and its identifiers and fields for one part. Runs in a worker thread.
+    #
+    mydata8, resp8 = call_api({'op':'GetPartMetadata','id':partid})
+    part = resp8['Result'][0]
+    progress.step()
+    return part['PartID'], part_values(part)
 #
 #
 #     Main Routine
 #
 titleid = get_input()           # Prompt the user for the title id 
+state = ld_state(titleid)       # Items, parts and identifiers saved by the last run
+refresh = False
+if state['parts'] or state['items']:
+    answer = input('Refresh from the last run, fetching only new and changed items and parts? (y/n: ')
+    if None == re.fullmatch(r'[yYnN]',answer):
+        print('Enter y to refresh from the last run and n to fetch every item and part.')
+        exit()
+    refresh = answer in ('y','Y')
 tsvfile = opn_output()     # Open the output tsv file and write column headings to it
 
 #  Get all items for the selected title
 #
-url = service_url + urllib.parse.urlencode({'op':'GetTitleMetadata', 'id': titleid,'items':'t','format': 'json','apikey':BHL_key})
-uh=urllib.request.urlopen(url)
-#print(url)
-mydata=uh.read().decode('utf-8')
-resp=json.loads(mydata)
-if 'Status' not in resp or resp['Status'] != 'ok':# Successful API invocation?
+items = stream_api({'op':'GetTitleMetadata', 'id': titleid,'items':'t'}, ('Result', 0, 'Items'))   # Items are read one at a time
+if items.fields.get('Status') != 'ok':# Successful API invocation?
     print('==== Failure to retrieve items ====')         # Exit if unsuccessful
-    print(mydata)
+    print(items.fields)
     exit()
 
-for item in resp['Result'][0]['Items']:                       # Process each item for this title
-    crnt_item = item['ItemID']
-    url = service_url + urllib.parse.urlencode({'op':'GetItemMetadata','id':crnt_item,'parts':'t','format':'json','apikey':BHL_key})
-    #print(url)
-    uh = urllib.request.urlopen(url)
-    mydata=uh.read().decode('utf-8')
-    resp2 = json.loads(mydata)
-    #print(resp2)
-    if 'Status' not in resp2 or resp2['Status'] != 'ok':
-        print('==== Failure to retrieve  parts ====')
-        print(mydata)
-        exit()
-    if 'Parts' not in resp2['Result'][0].keys():   
-        continue
-    for part in resp2['Result'][0]['Parts']:                  # Process each part for this item
-        url = service_url + urllib.parse.urlencode({'op':'GetPartMetadata','id':part['PartID'],'format':'json','apikey':BHL_key})
-        #print(url)
-        uh = urllib.request.urlopen(url)
-        mydata8 = uh.read().decode('utf-8')
-        resp8 = json.loads(mydata8)
-        partID = resp8['Result'][0]['PartID']
-        BioStorID=''
-        for identifier in resp8['Result'][0]['Identifiers']:  # Check each identifier looking for the BioStor identifier
-            if identifier['IdentifierName'] =='BioStor':
-                BioStorID=identifier['IdentifierValue']
-        print(partID)
-        tsvfile.writerow((partID,BioStorID))
-
-fileh.close()   # Close the output tsv file
-    
-
+now = time.time()
+old_items = state['items'] if refresh else {}
+old_parts = state['parts'] if refresh else {}
+new_state = {'items':{}, 'parts':{}}
+rows = []
+pool = ThreadPoolExecutor(max_workers=max_workers)
+try:
+    #
+    # Results are collected in submission order, so the output rows follow the order of the items and parts in BHL.
+    # The parts of each item are requested as soon as the item is read from the GetTitleMetadata response. Only the item id and
+    # fingerprint of each item are kept.
+    #
+    progress = bhl_stats.Progress('items and parts')                                         # Progress line replaces printing each part id
+    item_sigs = []       # (item id, fingerprint) of every item, in BHL order
+    fetched = {}         # Requests for the parts of stale items. Key is the item id.
+    for item in items:
+        itemid, sig = item['ItemID'], item_sig(item)
+        item_sigs.append((itemid, sig))
+        old = old_items.get(str(itemid))
+        if old is None or old['sig'] != sig or now - old['checked'] > item_recheck_days * 86400:
+            progress.add_total(1)
+            fetched[itemid] = pool.submit(get_item_parts, itemid)
+    partids = []                                                                            # Part ids for every item, in item order
+    for itemid, sig in item_sigs:
+        if itemid in fetched:
+            new_state['items'][str(itemid)] = {'sig':sig, 'parts':fetched[itemid].result(), 'checked':now, 'seen':now}
+        else:
+            new_state['items'][str(itemid)] = dict(old_items[str(itemid)], seen=now)
+        partids.extend(new_state['items'][str(itemid)]['parts'])
 
+    todo = []            # Parts not already resolved
+    for partid in partids:
+        old = old_parts.get(str(partid))
+        if old is None or any(col not in old['ids'] for col in columns) or \
+                (any(old['ids'].get(col, '') == '' for col in required_ids) and now - old['checked'] > part_recheck_days * 86400):
+            todo.append(partid)
+    progress.add_total(len(todo))
+    resolved = dict(zip(todo, pool.map(get_part_ids, todo)))
+    for partid in partids:                                                                  # Process each part for this title
+        if partid in resolved:
+            partID, values = resolved[partid]
+            new_state['parts'][str(partid)] = {'ids':values, 'checked':now, 'seen':now}
+        else:
+            partID, values = partid, old_parts[str(partid)]['ids']
+            new_state['parts'][str(partid)] = dict(old_parts[str(partid)], seen=now)
+        rows.append((partID,values))
+        tsvfile.writerow([partID] + [values[col] for col in columns])
+    progress.close()
+finally:
+    pool.shutdown(cancel_futures=True)   # Don't wait for queued requests if a worker failed
 
+fileh.close()   # Close the output tsv file
+if state['parts']:
+    wrt_delta(state['parts'], rows)      # Changes since the last run
+wrt_state(titleid, new_state)
+if store_file:
+    store = bhl_store.opn_store(store_file)
+    bhl_store.upsert(store, titleid, rows, columns)   # Parts already in the store are updated
+    store.close()
+bhl_cache.report()
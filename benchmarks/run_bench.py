@@ -0,0 +1,109 @@
+#
+# Offline benchmark for BioStorID.py, cr2bhl.py and toc_plmd.py. Each program is run end to end against the local stub server
+# (stub_server.py) and the wall time, requests issued, requests per second and peak memory (RSS) of the run are reported.
+#
+#  Each run starts in a new empty directory, so the response cache (bhl_cache.sqlite) is cold and output files do not collide.
+#  Use --warm to run every program a second time in the same directory to measure a run answered from the cache.
+#
+#  Sample calls
+#    python benchmarks/run_bench.py
+#    python benchmarks/run_bench.py --items 500 --parts 40 --latency 20 --repeat 3 --output bench.json
+#
+#  Load needed libraries
+#
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+import urllib.request
+import stub_server
+
+repo = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+programs = {        # Program file and the answers typed at its prompts
+    'BioStorID': ('BioStorID.py', '1\nn\n'),     # n: don't refresh from the saved state in the warm run
+    'cr2bhl': ('cr2bhl.py', '1234-5678\n1900\n2100\nbench\ny\n'),
+    'toc_plmd': ('toc_plmd.py', 't1\n'),
+}
+
+def stub_stats(base):
+    with urllib.request.urlopen(base + '_stats') as uh:
+        return json.loads(uh.read())
+
+def run_program(name, base, workdir, env):
+    #
+    # Run one program in workdir. Returns wall time, exit status and peak RSS in MB.
+    #
+    script, answers = programs[name]
+    start = time.monotonic()
+    with open(os.path.join(workdir, name + '.log'), 'w') as log:
+        proc = subprocess.Popen([sys.executable, os.path.join(repo, script)], cwd=workdir, env=env,
+                                stdin=subprocess.PIPE, stdout=log, stderr=subprocess.STDOUT)
+        proc.stdin.write(answers.encode())
+        proc.stdin.close()
+        pid, status, usage = os.wait4(proc.pid, 0)
+        proc.returncode = os.waitstatus_to_exitcode(status)
+    elapsed = time.monotonic() - start
+    rss_unit = 1024.0 * 1024.0 if sys.platform == 'darwin' else 1024.0      # ru_maxrss is in bytes on macOS, in kB on Linux
+    return elapsed, proc.returncode, usage.ru_maxrss / rss_unit
+
+def bench(name, base, args, env):
+    #
+    # Run one program args.repeat times. Returns a list of result dictionaries.
+    #
+    results = []
+    for run in range(args.repeat):
+        workdir = tempfile.mkdtemp(prefix='bench_' + name + '_')
+        try:
+            for phase in (['cold', 'warm'] if args.warm else ['cold']):
+                urllib.request.urlopen(base + '_reset').read()
+                elapsed, status, rss = run_program(name, base, workdir, env)
+                stats = stub_stats(base)
+                results.append({'program': name, 'run': run + 1, 'cache': phase, 'status': status, 'seconds': round(elapsed, 3),
+                                'requests': stats['requests'], 'requests_per_second': round(stats['requests'] / elapsed, 1) if elapsed else 0,
+                                'bytes': stats['bytes'], 'peak_rss_mb': round(rss, 1), 'by_op': stats['by_op']})
+                if status != 0:
+                    with open(os.path.join(workdir, name + '.log')) as log:
+                        print(log.read()[-2000:])
+        finally:
+            if not args.keep:
+                shutil.rmtree(workdir, ignore_errors=True)
+            else:
+                print('Output kept in', workdir)
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the BHL programs against a local stub server')
+    parser.add_argument('programs', nargs='*', default=list(programs), help='programs to run (default: all)')
+    parser.add_argument('--items', type=int, default=50, help='items in the synthetic title')
+    parser.add_argument('--parts', type=int, default=20, help='parts per item')
+    parser.add_argument('--pages', type=int, default=200, help='pages per item')
+    parser.add_argument('--latency', type=float, default=0, help='milliseconds added to every stub response')
+    parser.add_argument('--errors', type=float, default=0, help='fraction of stub requests answered with 503')
+    parser.add_argument('--fixtures', help='directory of recorded responses served instead of synthetic ones')
+    parser.add_argument('--rate', type=float, default=1000, help='request rate cap passed to the programs (BHL_MAX_RATE)')
+    parser.add_argument('--repeat', type=int, default=1, help='runs per program')
+    parser.add_argument('--warm', action='store_true', help='also run each program again with a warm cache')
+    parser.add_argument('--keep', action='store_true', help='keep the working directories')
+    parser.add_argument('--output', help='write the results to this json file')
+    args = parser.parse_args()
+
+    server = stub_server.start(0, args.latency, args.errors, items=args.items, parts=args.parts, pages=args.pages, fixtures=args.fixtures)
+    base = 'http://%s:%d/' % server.server_address
+    env = dict(os.environ, BHL_URL=base, CROSSREF_URL=base + 'works', BHL_MAX_RATE=str(args.rate), PYTHONPATH=repo)
+
+    results = []
+    for name in args.programs:
+        results.extend(bench(name, base, args, env))
+    server.shutdown()
+
+    print(f'{"program":<10} {"run":>3} {"cache":<5} {"status":>6} {"seconds":>9} {"requests":>9} {"req/s":>8} {"peak MB":>8}')
+    for r in results:
+        print(f'{r["program"]:<10} {r["run"]:>3} {r["cache"]:<5} {r["status"]:>6} {r["seconds"]:>9.2f} {r["requests"]:>9} {r["requests_per_second"]:>8.1f} {r["peak_rss_mb"]:>8.1f}')
+    if args.output:
+        with open(args.output, 'w') as fh:
+            json.dump({'settings': vars(args), 'results': results}, fh, indent=2)
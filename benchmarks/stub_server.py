@@ -0,0 +1,214 @@
+#
+# Local stand-in for the BHL api3 and openurl endpoints and the Crossref works endpoint. Used by run_bench.py.
+#
+#  Responses are synthetic: one title with a configurable number of items, parts per item and pages per item. The Crossref
+#  works endpoint returns one journal article for each BHL part, paged with a cursor, so the Crossref to BHL matching in
+#  cr2bhl.py finds every part. Recorded responses can be served instead: put them in a fixtures directory as <op>-<id>.json,
+#  e.g. GetItemMetadata-12345.json, openurl-<title>.json or works-<cursor>.json. Every response can be delayed by a fixed latency,
+#  and a fraction of requests can be answered with 503 to exercise client retries. Responses are gzip compressed when asked.
+#  Request counts per operation are returned by /_stats and reset by /_reset.
+#
+#  Sample call
+#    python stub_server.py --items 500 --parts 40 --latency 20
+#
+#  Load needed libraries
+#
+import os
+import sys
+import gzip
+import json
+import time
+import random
+import threading
+import argparse
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+class Fixture:
+    #
+    # Synthetic title. Item ids are 1000+n, part ids are item id * 1000 + n and page ids are item id * 10000 + n.
+    #
+    def __init__(self, items=50, parts=20, pages=200, fixtures=None):
+        self.items = items
+        self.parts = parts
+        self.pages = max(pages, parts * 4)
+        self.fixtures = fixtures
+
+    def recorded(self, op, key):
+        #
+        # Return a recorded response, or None
+        #
+        if self.fixtures:
+            name = os.path.join(self.fixtures, f'{op}-{key}.json')
+            if os.path.exists(name):
+                with open(name, 'rb') as fh:
+                    return fh.read()
+        return None
+
+    def item(self, n):
+        vol = n + 1
+        return {'ItemID': 1000 + n, 'TitleID': 1, 'Volume': f'v.{vol} ({1900 + n})', 'Year': str(1900 + n)}
+
+    def part(self, itemid, n):
+        vol = itemid - 1000 + 1
+        return {'PartID': itemid * 1000 + n, 'ItemID': itemid, 'Genre': 'Article', 'Title': f'Notes on the genus Synthetica part {vol}.{n}',
+                'Volume': str(vol), 'StartPageNumber': str(n * 4 + 1), 'EndPageNumber': str(n * 4 + 4), 'Date': str(1899 + vol),
+                'StartPageID': itemid * 10000 + n * 4 + 1}
+
+    def page(self, itemid, n):
+        vol = itemid - 1000 + 1
+        types = [{'PageTypeName': 'Table of Contents' if n == 0 else 'Text'}]
+        return {'PageID': itemid * 10000 + n, 'ItemID': itemid, 'Volume': str(vol), 'Issue': '1', 'Year': str(1899 + vol),
+                'PageNumbers': [{'Prefix': 'Page', 'Number': str(n)}] if n else [], 'PageTypes': types}
+
+    def api3(self, q):
+        op = q.get('op', '')
+        key = q.get('id') or q.get('pageid', '')
+        body = self.recorded(op, key)
+        if body is not None:
+            return body
+        if op == 'GetTitleMetadata':
+            result = {'TitleID': 1, 'Items': [self.item(n) for n in range(self.items)]}
+        elif op == 'GetItemMetadata':
+            itemid = int(key)
+            result = dict(self.item(itemid - 1000))
+            if q.get('parts') == 't':
+                result['Parts'] = [self.part(itemid, n) for n in range(self.parts)]
+            if q.get('pages') == 't':
+                result['Pages'] = [self.page(itemid, n) for n in range(self.pages)]
+        elif op == 'GetPartMetadata':
+            partid = int(key)
+            result = dict(self.part(partid // 1000, partid % 1000))
+            result['Doi'] = f'10.5962/bhl.part.{partid}'
+            result['Identifiers'] = [{'IdentifierName': 'BioStor', 'IdentifierValue': str(partid + 7)}]
+        elif op == 'GetPageMetadata':
+            pageid = int(key)
+            itemid = pageid // 10000
+            lines = []
+            for n in range(self.parts):
+                lines.append(f'AUTHOR{n}, A. B.\nNotes on the genus Synthetica\npart {itemid - 999}.{n} {n * 4 + 1}\n')
+            result = {'PageID': pageid, 'ItemID': itemid, 'OcrText': ''.join(lines)}
+        else:
+            return json.dumps({'Status': 'error', 'ErrorMessage': 'Unknown op ' + op, 'Result': None}).encode()
+        return json.dumps({'Status': 'ok', 'ErrorMessage': '', 'Result': [result]}).encode()
+
+    def openurl(self, q):
+        body = self.recorded('openurl', q.get('title', ''))
+        if body is not None:
+            return body
+        return json.dumps({'Status': 'ok', 'citations': []}).encode()
+
+    def works(self, q):
+        cursor = q.get('cursor', '*')
+        body = self.recorded('works', cursor)
+        if body is not None:
+            return body
+        start = 0 if cursor == '*' else int(cursor)
+        rows = int(q.get('rows', 20))
+        total = self.items * self.parts
+        items = []
+        for num in range(start, min(start + rows, total)):
+            part = self.part(1000 + num // self.parts, num % self.parts)
+            items.append({'type': 'journal-article', 'DOI': f'10.9999/synth.{num}', 'title': [part['Title']], 'volume': part['Volume'],
+                          'issue': '1', 'page': part['StartPageNumber'] + '-' + part['EndPageNumber'],
+                          'author': [{'family': 'Author', 'given': str(num)}], 'published-print': {'date-parts': [[int(part['Date']), 1]]}})
+        message = {'total-results': total, 'items': items, 'next-cursor': str(start + len(items))}
+        return json.dumps({'status': 'ok', 'message-type': 'work-list', 'message': message}).encode()
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 64             # Programs open many connections at once. Connections beyond the listen backlog wait a second.
+
+    def __init__(self, address, fixture, latency=0.0, errors=0.0):
+        super().__init__(address, Handler)
+        self.fixture = fixture
+        self.latency = latency          # Seconds added to every response
+        self.errors = errors            # Fraction of requests answered with 503
+        self.counts = {}                # Requests served. Key is the operation.
+        self.bytes = 0
+        self.lock = threading.Lock()
+
+    def count(self, op, size):
+        with self.lock:
+            self.counts[op] = self.counts.get(op, 0) + 1
+            self.bytes += size
+
+    def stats(self):
+        with self.lock:
+            return {'requests': sum(self.counts.values()), 'bytes': self.bytes, 'by_op': dict(self.counts)}
+
+    def reset(self):
+        with self.lock:
+            self.counts = {}
+            self.bytes = 0
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'       # Allow clients to keep connections open
+    disable_nagle_algorithm = True      # Send headers and body without waiting for an ack, like a production server
+
+    def do_GET(self):
+        parts = urllib.parse.urlsplit(self.path)
+        q = dict(urllib.parse.parse_qsl(parts.query))
+        path = parts.path.rstrip('/')
+        if path == '/_stats':
+            return self.reply(json.dumps(self.server.stats()).encode())
+        if path == '/_reset':
+            self.server.reset()
+            return self.reply(b'{}')
+        if path.endswith('/api3'):
+            op, body = q.get('op', 'api3'), self.server.fixture.api3(q)
+        elif path.endswith('/openurl'):
+            op, body = 'openurl', self.server.fixture.openurl(q)
+        elif path.endswith('/works'):
+            op, body = 'works', self.server.fixture.works(q)
+        else:
+            self.send_error(404)
+            return
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if self.server.errors and random.random() < self.server.errors:
+            self.server.count(op + ' (503)', 0)
+            return self.reply(b'Service unavailable', 503)
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            body = gzip.compress(body, 1)
+            self.server.count(op, len(body))
+            return self.reply(body, headers={'Content-Encoding': 'gzip'})
+        self.server.count(op, len(body))
+        self.reply(body)
+
+    def reply(self, body, status=200, headers={}):
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def start(port=0, latency_ms=0, errors=0.0, **fixture_args):
+    #
+    # Start a stub server in a background thread. Returns the server; its address is server.server_address.
+    #
+    server = StubServer(('127.0.0.1', port), Fixture(**fixture_args), latency_ms / 1000.0, errors)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local stand-in for the BHL and Crossref APIs')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--items', type=int, default=50, help='items in the title')
+    parser.add_argument('--parts', type=int, default=20, help='parts per item')
+    parser.add_argument('--pages', type=int, default=200, help='pages per item')
+    parser.add_argument('--latency', type=float, default=0, help='milliseconds added to every response')
+    parser.add_argument('--errors', type=float, default=0, help='fraction of requests answered with 503')
+    parser.add_argument('--fixtures', help='directory of recorded responses')
+    args = parser.parse_args()
+    server = start(args.port, args.latency, args.errors, items=args.items, parts=args.parts, pages=args.pages, fixtures=args.fixtures)
+    print('Serving on http://%s:%d/  (BHL_URL=http://%s:%d/  CROSSREF_URL=http://%s:%d/works)' % (server.server_address * 3))
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        sys.exit(0)
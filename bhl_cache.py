@@ -0,0 +1,207 @@
+#
+# Persistent on-disk cache for BHL API3 and openURL responses. It is shared by BioStorID.py, cr2bhl.py and toc_plmd.py.
+#
+#  Responses are kept in a SQLite database. The key is the request URL with the apikey removed and the remaining
+#  parameters sorted, so the same request made by different people or in a different parameter order is found in the cache.
+#  Each API operation has its own time to live (ttl below). When the database grows beyond max_bytes, the least recently
+#  used responses are removed. Set cache_only to True to work offline: requests are answered from the cache and a request
+#  that is not in the cache stops the program.
+#
+#  Sample use
+#    mydata = bhl_cache.get_url(url)
+#    records = bhl_stream.Records(bhl_cache.open_url(url), ('Result', 0, 'Items'))   # Or bhl_stream.open_records(url, ...) with retries
+#    bhl_cache.report()
+#
+#  Load needed libraries
+#
+import re
+import sqlite3
+import threading
+import time
+import urllib.parse
+import zlib
+import bhl_client
+import bhl_stats
+#
+# Global variables
+#
+cache_file = 'bhl_cache.sqlite'      # SQLite database that holds cached responses
+cache_only = False                   # True: answer from the cache only and never call BHL
+max_bytes = 500 * 1024 * 1024        # Size bound for the stored (compressed) responses
+ttl = {                              # Seconds that a cached response stays valid. Key is the API3 op or the service name.
+    'GetTitleMetadata': 86400,
+    'GetItemMetadata': 7 * 86400,
+    'GetPartMetadata': 30 * 86400,
+    'GetPageMetadata': 30 * 86400,
+    'openurl': 7 * 86400,
+}
+default_ttl = 86400                  # Time to live for operations not listed in ttl
+hits = 0                             # Requests answered from the cache
+misses = 0                           # Requests sent to BHL
+
+db = None
+db_bytes = 0                         # Current size of the stored responses
+lock = threading.Lock()              # The connection is shared by all worker threads
+
+def opn_cache():
+    #
+    #  Open the cache database, creating it if needed
+    #
+    global db, db_bytes
+    db = sqlite3.connect(cache_file, timeout=60, check_same_thread=False)   # Wait for other processes writing the cache
+    db.execute('CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, op TEXT, stored REAL, accessed REAL, size INTEGER, body BLOB)')
+    db.execute('CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)')
+    db_bytes = db.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+
+def cache_key(url):
+    #
+    #  Build the cache key and operation name for a URL. The apikey is removed and the parameters are sorted.
+    #
+    parts = urllib.parse.urlsplit(url)
+    params = sorted((k, v) for k, v in urllib.parse.parse_qsl(parts.query, keep_blank_values=True) if k != 'apikey')
+    op = dict(params).get('op') or parts.path.rstrip('/').split('/')[-1]
+    return parts.netloc + parts.path + '?' + urllib.parse.urlencode(params), op
+
+def evict():
+    #
+    #  Remove the least recently used responses until the cache is back under max_bytes. Called with the lock held.
+    #
+    global db_bytes
+    while db_bytes > max_bytes:
+        rows = db.execute('SELECT key, size FROM responses ORDER BY accessed LIMIT 100').fetchall()
+        if not rows:
+            break
+        for key, size in rows:
+            db.execute('DELETE FROM responses WHERE key = ?', (key,))
+            db_bytes -= size
+            if db_bytes <= max_bytes:
+                break
+
+def lookup(url, refresh):
+    #
+    #  Return the cache key, operation name and compressed cached body for url. The body is None when BHL must be called.
+    #
+    global hits, misses
+    key, op = cache_key(url)
+    now = time.time()
+    with lock:
+        if db is None:
+            opn_cache()
+        row = db.execute('SELECT stored, body FROM responses WHERE key = ?', (key,)).fetchone()
+        if row and (cache_only or (not refresh and now - row[0] < ttl.get(op, default_ttl))):   # Fresh copy in the cache?
+            hits += 1
+            bhl_stats.record_hit(op)
+            db.execute('UPDATE responses SET accessed = ? WHERE key = ?', (now, key))
+            db.commit()
+            return key, op, row[1]
+        if cache_only:
+            print('==== Not in cache: ' + key + ' ====')
+            exit()
+        misses += 1
+    return key, op, None
+
+def store(key, op, body):
+    #
+    #  Store a compressed response body
+    #
+    global db_bytes
+    now = time.time()
+    with lock:
+        old = db.execute('SELECT size FROM responses WHERE key = ?', (key,)).fetchone()
+        db.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)', (key, op, now, now, len(body), body))
+        db_bytes += len(body) - (old[0] if old else 0)
+        evict()
+        db.commit()
+
+def keep(op, head):
+    #
+    #  Failed API3 responses are not kept. head is the start of the response.
+    #
+    return op == 'openurl' or re.search(r'"Status"\s*:\s*"ok"', head[:200]) is not None
+
+def get_url(url, refresh=False):
+    #
+    #  Return the response text for url, from the cache when a fresh copy is stored. Otherwise call BHL through bhl_client
+    #  and store the response. refresh True always calls BHL (unless cache_only is set) and replaces the cached copy.
+    #
+    key, op, body = lookup(url, refresh)
+    if body is not None:
+        return zlib.decompress(body).decode('utf-8')
+    mydata = bhl_client.get(url, op).decode('utf-8')
+    if keep(op, mydata):
+        store(key, op, zlib.compress(mydata.encode('utf-8')))
+    return mydata
+
+class Inflater:
+    #
+    #  Read a cached response in pieces without decompressing all of it at once
+    #
+    def __init__(self, body):
+        self.body = body
+        self.inflate = zlib.decompressobj()
+        self.pos = 0
+
+    def read(self, size=-1):
+        if size <= 0:
+            data = self.inflate.decompress(self.inflate.unconsumed_tail + self.body[self.pos:]) + self.inflate.flush()
+            self.pos = len(self.body)
+            return data
+        data = b''
+        while not data:
+            if self.inflate.unconsumed_tail:
+                data = self.inflate.decompress(self.inflate.unconsumed_tail, size)
+            elif self.pos < len(self.body):
+                data = self.inflate.decompress(self.body[self.pos:self.pos + size], size)
+                self.pos += size
+            else:
+                return self.inflate.flush()
+        return data
+
+    def close(self):
+        pass
+
+class Recorder:
+    #
+    #  Read a response from BHL in pieces and compress a copy as it goes. The copy is stored when the whole response has been read.
+    #
+    def __init__(self, resp, key, op):
+        self.resp = resp
+        self.key = key
+        self.op = op
+        self.deflate = zlib.compressobj()
+        self.parts = []
+        self.head = b''
+
+    def read(self, size=-1):
+        data = self.resp.read(size)
+        if len(self.head) < 200:
+            self.head += data[:200]
+        if data:
+            self.parts.append(self.deflate.compress(data))
+        elif self.parts is not None:
+            self.parts.append(self.deflate.flush())
+            if keep(self.op, self.head.decode('utf-8', 'replace')):
+                store(self.key, self.op, b''.join(self.parts))
+            self.parts = None
+        if size <= 0 and data:
+            return data + self.read()
+        return data
+
+    def close(self):
+        self.resp.close()
+
+def open_url(url, refresh=False):
+    #
+    #  As get_url, but return a file-like object whose read() gives the response bytes in pieces. For large responses read with
+    #  bhl_stream: the response is never held in memory uncompressed. A response from BHL is stored once it has been read to the end.
+    #
+    key, op, body = lookup(url, refresh)
+    if body is not None:
+        return Inflater(body)
+    return Recorder(bhl_client.open_url(url, op), key, op)
+
+def report():
+    #
+    #  Print the cache hit and miss counters
+    #
+    print(f'Cache: {hits} hits, {misses} misses')
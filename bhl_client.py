@@ -0,0 +1,251 @@
+#
+# Shared HTTP client for the BHL API3, BHL openURL and Crossref requests made by BioStorID.py, cr2bhl.py and toc_plmd.py.
+#
+#  Connections are kept open and reused (one pool per host), responses are requested gzip compressed, and every request has
+#  a timeout. Connection errors, timeouts and 429/500/502/503/504 responses are retried with exponential backoff and random
+#  jitter, honouring a Retry-After header. Requests to each host are paced by a token bucket. When a server answers 429 or
+#  503 the rate for that host is halved; it then climbs back to max_rate while requests succeed. Every attempt is recorded
+#  in bhl_stats.
+#
+#  Sample use
+#    mydata = bhl_client.get(url).decode('utf-8')
+#    with bhl_client.open_url(url) as resp:       # Read a large response in pieces
+#        chunk = resp.read(65536)
+#
+#  Load needed libraries
+#
+import os
+import ssl
+import time
+import zlib
+import random
+import threading
+import http.client
+import urllib.parse
+import urllib.error
+import bhl_stats
+#
+# Global variables
+#
+max_rate = float(os.environ.get('BHL_MAX_RATE',10))   # Requests per second sent to each host when all is well
+min_rate = 0.2             # The rate is never lowered below this after 429/503 responses
+burst = 2                  # Requests that may be sent at once after a pause
+timeout = 60               # Seconds to wait for a connection or a response
+max_retries = 5            # Attempts after the first one before giving up
+backoff = 1.0              # Seconds to wait before the first retry. Doubled for each further retry, with jitter.
+max_backoff = 60           # Longest wait between attempts
+max_connections = 8        # Idle connections kept open per host
+user_agent = 'piwg-citations (https://github.com/gbhl/piwg-citations)'
+
+retry_status = {429, 500, 502, 503, 504}
+redirect_status = {301, 302, 303, 307, 308}
+max_redirects = 5
+slow_status = {429, 503}   # Responses that ask the client to send requests more slowly
+
+pools = {}                 # Idle connections. Key is (scheme, host).
+buckets = {}               # Token buckets. Key is the host.
+lock = threading.Lock()
+ssl_context = ssl.create_default_context()
+
+class TokenBucket:
+    #
+    # Pace requests to one host. take() waits until a token is available. The rate adapts to the server's answers.
+    #
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1                              # A negative balance reserves a place in the queue
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+    def slow_down(self):
+        with self.lock:
+            self.rate = max(min_rate, self.rate / 2)
+
+    def speed_up(self):
+        with self.lock:
+            self.rate = min(max_rate, self.rate * 1.05)
+
+def get_bucket(host):
+    with lock:
+        if host not in buckets:
+            buckets[host] = TokenBucket(max_rate, burst)
+        return buckets[host]
+
+def get_conn(scheme, host):
+    #
+    # Return an idle connection to the host, or a new one. The second value is True when the connection was used before.
+    #
+    with lock:
+        idle = pools.get((scheme, host))
+        if idle:
+            return idle.pop(), True
+    if scheme == 'https':
+        return http.client.HTTPSConnection(host, timeout=timeout, context=ssl_context), False
+    return http.client.HTTPConnection(host, timeout=timeout), False
+
+def put_conn(scheme, host, conn):
+    #
+    # Keep a connection open for reuse, or close it when the pool for the host is full
+    #
+    with lock:
+        idle = pools.setdefault((scheme, host), [])
+        if len(idle) < max_connections:
+            idle.append(conn)
+            return
+    conn.close()
+
+def op_name(url):
+    #
+    # Name of the operation used for bhl_stats: the API3 op, otherwise the last part of the path (openurl, works)
+    #
+    parts = urllib.parse.urlsplit(url)
+    return urllib.parse.parse_qs(parts.query).get('op',[''])[0] or parts.path.rstrip('/').split('/')[-1]
+
+def retry_wait(attempt, retry_after):
+    #
+    # Seconds to wait before the next attempt: the server's Retry-After if given, otherwise exponential backoff with full jitter
+    #
+    if retry_after and retry_after.isdigit():
+        return min(max_backoff, int(retry_after))
+    return random.uniform(0, min(max_backoff, backoff * 2 ** attempt))
+
+class Response:
+    #
+    # Body of a successful response, read in pieces with read(). A gzip body is decompressed as it is read. When the whole body
+    # has been read the request is recorded in bhl_stats and the connection goes back to the pool; close() before the end
+    # drops the connection.
+    #
+    def __init__(self, resp, conn, scheme, host, op, start):
+        self.resp = resp
+        self.conn = conn
+        self.scheme = scheme
+        self.host = host
+        self.op = op
+        self.start = start
+        self.nbytes = 0
+        self.done = False
+        self.inflate = zlib.decompressobj(16 + zlib.MAX_WBITS) if resp.getheader('Content-Encoding','').lower() == 'gzip' else None
+
+    def read(self, size=-1):
+        #
+        # Return up to size bytes of the (decompressed) body, or all that is left when size is negative. b'' at the end.
+        #
+        while not self.done:
+            try:
+                data = self.resp.read(size) if size > 0 else self.resp.read()
+            except (OSError, http.client.HTTPException):
+                bhl_stats.record(self.op, time.monotonic() - self.start, self.nbytes, error=True)
+                self.done = True
+                self.conn.close()
+                raise
+            self.nbytes += len(data)
+            if not data or size <= 0:
+                self.finish()
+            if self.inflate:
+                data = self.inflate.decompress(data) + (self.inflate.flush() if self.done else b'')
+            if data or self.done:
+                return data
+        return b''
+
+    def finish(self):
+        self.done = True
+        bhl_stats.record(self.op, time.monotonic() - self.start, self.nbytes)
+        if self.resp.will_close:
+            self.conn.close()
+        else:
+            put_conn(self.scheme, self.host, self.conn)
+
+    def close(self):
+        if not self.done:
+            self.done = True
+            self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def get(url, op=None):
+    #
+    # Send a GET request and return the response body as bytes. Raises urllib.error.HTTPError for error responses that are not
+    # retried, or when all retries fail.
+    #
+    op = op or op_name(url)
+    attempt = 0
+    while True:
+        with open_url(url, op) as resp:
+            try:
+                return resp.read()
+            except (OSError, http.client.HTTPException) as err:     # Connection lost while the body was read
+                if attempt >= max_retries:
+                    raise urllib.error.URLError(err)
+        time.sleep(retry_wait(attempt, None))
+        attempt += 1
+        bhl_stats.record_retry(op)
+
+def open_url(url, op=None):
+    #
+    # Send a GET request and return a Response whose body is read in pieces, for responses too large to hold in memory.
+    # Failures before the body starts are retried as in get(); a connection lost while the body is read raises OSError.
+    #
+    op = op or op_name(url)
+    headers = {'Accept-Encoding': 'gzip', 'User-Agent': user_agent, 'Connection': 'keep-alive'}
+    attempt = redirects = 0
+    stale_retry = True
+    while True:
+        parts = urllib.parse.urlsplit(url)
+        path = (parts.path or '/') + ('?' + parts.query if parts.query else '')
+        bucket = get_bucket(parts.netloc)
+        bucket.take()
+        conn, reused = get_conn(parts.scheme, parts.netloc)
+        start = time.monotonic()
+        try:
+            conn.request('GET', path, headers=headers)
+            resp = conn.getresponse()
+            if 200 <= resp.status < 300:
+                bucket.speed_up()
+                return Response(resp, conn, parts.scheme, parts.netloc, op, start)
+            body = resp.read()
+        except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError) as err:
+            conn.close()
+            if reused and stale_retry:        # The server closed an idle connection. Try once more on a new one.
+                stale_retry = False
+                continue
+            status, retry_after, error = None, None, err
+        except (OSError, http.client.HTTPException) as err:    # Timeouts and other connection failures
+            conn.close()
+            status, retry_after, error = None, None, err
+        else:
+            if resp.will_close:
+                conn.close()
+            else:
+                put_conn(parts.scheme, parts.netloc, conn)
+            status, retry_after, error = resp.status, resp.getheader('Retry-After'), None
+            if status in redirect_status and resp.getheader('Location') and redirects < max_redirects:
+                bhl_stats.record(op, time.monotonic() - start, len(body))
+                url = urllib.parse.urljoin(url, resp.getheader('Location'))
+                redirects += 1
+                continue
+        bhl_stats.record(op, time.monotonic() - start, error=True)
+        if status in slow_status:
+            bucket.slow_down()
+        if (status is None or status in retry_status) and attempt < max_retries:
+            time.sleep(retry_wait(attempt, retry_after))
+            attempt += 1
+            bhl_stats.record_retry(op)
+            continue
+        if error is not None:
+            raise urllib.error.URLError(error)
+        raise urllib.error.HTTPError(url, status, resp.reason, resp.headers, None)
@@ -0,0 +1,154 @@
+#
+# Parse BHL item volume enumeration and look up items by series, volume, issue and year. Used by cr2bhl.py.
+#
+#  Enumeration strings such as 'v.12 (1905)', 'v.1-2=no.1-8 (1950-1951)', 'ser.2:v.3 (1890)' or 'v.5:no.3 (1920)' are parsed into
+#  Enumeration records. The records are kept in a sorted interval index for each series, so a lookup by volume number is a bisect
+#  search rather than a scan, and items holding a range of volumes are found without expanding the range. Every matching item is
+#  returned, so items that share a volume (e.g. one item per part of a volume) are no longer overwritten by later items. The most
+#  specific item comes first: the narrowest volume range, then items whose issue and year ranges were matched rather than missing,
+#  so a bound index 'v.1-50' does not win over 'v.5:no.4'.
+#
+#  Sample use
+#    index = bhl_enum.ItemIndex()
+#    index.add(12345, 'v.1-2=no.1-8 (1950-1951)')
+#    index.lookup(volume=2, issue=5)          # [12345]
+#
+#  Load needed libraries
+#
+import re
+from bisect import bisect_right
+from collections import namedtuple
+
+Enumeration = namedtuple('Enumeration', 'itemid series vol_start vol_end issue_start issue_end year_start year_end')
+
+series_re = re.compile(r'\b(?:ser(?:ies)?\.?\s*(\d+)|(n\.\s*s)\.)', re.I)            # 'ser.2' or 'n.s.'
+volume_re = re.compile(r'\bv\.\s*(\d+)(?:\s*-\s*(\d+))?', re.I)                      # 'v.12' or 'v.1-2'
+issue_re = re.compile(r'\b(?:nos?|pts?|nr|heft)\.?\s*(\d+)(?:\s*-\s*(\d+))?', re.I)      # 'no.3', 'no.1-8', 'pt.2'
+year_re = re.compile(r'\b(1[5-9]\d\d|20\d\d)(?:\s*[-/]\s*(\d{2,4}))?\b')              # '1905', '1950-1951', '1950/51'
+digits_re = re.compile(r'\d+')
+
+def to_int(value):
+    #
+    # Return the first number in a string, or None
+    #
+    mtch = digits_re.search(str(value or ''))
+    return int(mtch.group(0)) if mtch else None
+
+def parse_enum(itemid, enum, year=''):
+    #
+    # Parse one enumeration string. year, if given, is the item year from BHL and is used when the string holds no year.
+    # Returns an Enumeration record, or None when no volume number is found.
+    #
+    mtch = volume_re.search(enum)
+    if mtch is None:
+        return None
+    vol_start = int(mtch.group(1))
+    vol_end = int(mtch.group(2)) if mtch.group(2) else vol_start
+    series = ''
+    smtch = series_re.search(enum, 0, mtch.start())
+    if smtch:
+        series = smtch.group(1) or 'ns'
+    issue_start = issue_end = None
+    imtch = issue_re.search(enum, mtch.end())
+    if imtch:
+        issue_start = int(imtch.group(1))
+        issue_end = int(imtch.group(2)) if imtch.group(2) else issue_start
+    year_start = year_end = None
+    ymtch = year_re.search(enum, mtch.end()) or year_re.search(str(year or ''))
+    if ymtch:
+        year_start = int(ymtch.group(1))
+        year_end = year_start
+        if ymtch.group(2):
+            end = ymtch.group(2)
+            year_end = int(str(year_start)[:4-len(end)] + end)    # '1950/51' ends in 1951
+    return Enumeration(itemid, series, vol_start, max(vol_start, vol_end), issue_start, issue_end, year_start, year_end)
+
+class ItemIndex:
+    #
+    # Interval index of the items of one title. Key is the series; each series keeps its records sorted by first volume.
+    #
+    def __init__(self):
+        self.records = []      # Enumeration records in the order added
+        self.series = None     # Key is series. Other field is (first volumes, largest last volume so far, records), sorted by first volume.
+
+    def __len__(self):
+        return len(self.records)
+
+    def add(self, itemid, enum, year=''):
+        #
+        # Parse and add one item. Returns the Enumeration record, or None if the enumeration holds no volume number.
+        #
+        record = parse_enum(itemid, enum, year)
+        if record:
+            self.records.append(record)
+            self.series = None     # Rebuild the sorted lists on the next lookup
+        return record
+
+    def build(self):
+        #
+        # Sort the records of each series by first volume. Records that start with the same volume keep the order they were added.
+        #
+        self.series = {}
+        grouped = {}
+        for record in self.records:
+            grouped.setdefault(record.series,[]).append(record)
+        for series, records in grouped.items():
+            records.sort(key=lambda r: r.vol_start)
+            max_end = []
+            for record in records:
+                max_end.append(max(record.vol_end, max_end[-1] if max_end else record.vol_end))
+            self.series[series] = ([r.vol_start for r in records], max_end, records)
+
+    def lookup(self, volume, issue=None, year=None, series=None):
+        #
+        # Return the ids of all items holding the volume, most specific first. series None searches every series. issue and year,
+        # if given, must fall within the issue and year range of the item when the item enumeration includes them.
+        #
+        volume = to_int(volume)
+        issue = to_int(issue)
+        year = to_int(year)
+        if volume is None:
+            return []
+        if self.series is None:
+            self.build()
+        found = []
+        for key in ([series] if series is not None else self.series):
+            if key not in self.series:
+                continue
+            starts, max_end, records = self.series[key]
+            pos = bisect_right(starts, volume) - 1
+            hits = []
+            while pos >= 0 and max_end[pos] >= volume:    # Earlier records can only hold the volume while their ranges reach it
+                record = records[pos]
+                if record.vol_end >= volume \
+                   and (issue is None or record.issue_start is None or record.issue_start <= issue <= record.issue_end) \
+                   and (year is None or record.year_start is None or record.year_start <= year <= record.year_end):
+                    hits.append(record)
+                pos -= 1
+            hits.reverse()                                # Back to sorted order: by first volume, then in the order added
+            found.extend(hits)
+        def specificity(record):
+            #
+            # Sort key: width of the volume range, issue or year given but missing from the item, width of the matched ranges
+            #
+            issue_width = record.issue_end - record.issue_start if issue is not None and record.issue_start is not None else 0
+            year_width = record.year_end - record.year_start if year is not None and record.year_start is not None else 0
+            return (record.vol_end - record.vol_start, issue is not None and record.issue_start is None,
+                    year is not None and record.year_start is None, issue_width, year_width)
+        found.sort(key=specificity)                       # Stable, so equally specific items stay in sorted order
+        return [record.itemid for record in found]
+
+    def to_list(self):
+        #
+        # Return the records as lists, e.g. for saving in a json checkpoint file
+        #
+        return [list(record) for record in self.records]
+
+    @classmethod
+    def from_list(cls, rows):
+        #
+        # Rebuild an index from the output of to_list
+        #
+        index = cls()
+        index.records = [Enumeration(*row) for row in rows]
+        return index
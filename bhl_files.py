@@ -0,0 +1,31 @@
+#
+# Safe writing of state files for BioStorID.py, cr2bhl.py and toc_plmd.py.
+#
+#  A file opened with replace_file() is written under a temporary name (the file name followed by .tmp) and renamed over the old
+#  file only when it is complete. The rename is done in one step, so a crash never leaves half a file and a reader (e.g. a
+#  Prometheus collector) sees either the old file or the new one. If writing fails, the temporary file is removed and the old
+#  file is kept.
+#
+#  Sample use
+#    with bhl_files.replace_file('BioStor_state_1234.json') as fh:
+#        json.dump(state, fh)
+#
+#  Load needed libraries
+#
+import os
+from contextlib import contextmanager
+
+@contextmanager
+def replace_file(fname, encoding='utf-8'):
+    #
+    # Open a temporary file for writing text and replace fname with it when the with block ends without an error
+    #
+    tmp_name = fname + '.tmp'
+    try:
+        with open(tmp_name, 'w', encoding=encoding) as fh:
+            yield fh
+        os.replace(tmp_name, fname)
+    except BaseException:
+        if os.path.exists(tmp_name):
+            os.remove(tmp_name)
+        raise
@@ -0,0 +1,66 @@
+#
+# This program adds the identifiers saved by BioStorID.py (BioStor, DOI, TL-2, ...) to a segments tsv file written by cr2bhl.py or
+# toc_plmd.py. It replaces loading BioStor.tsv into Google Sheets and copying the identifiers with VLOOKUP.
+#
+# The segments file is read one row at a time and each row is written out at once with the identifier columns added, so files of
+# any size are joined in one pass. The identifiers are looked up in the local store (bhl_store.sqlite, see bhl_store.py) that
+# BioStorID.py fills for every title it processes. A row is matched by its Part ID column (cr2bhl.py output, when articles were
+# matched to existing BHL parts), otherwise by its Start Page BHL ID column (toc_plmd.py output) against the start page id of the
+# stored parts. Rows without a match get empty identifier columns.
+#
+#  Sample calls
+#    python bhl_join.py BHL_art_md.tsv
+#    python bhl_join.py ajb_1922_1923.tsv ajb_with_ids.tsv
+#
+#  The output file defaults to the input file name with _ids added, e.g. BHL_art_md_ids.tsv.
+#
+#  Import needed libraries
+#
+import os
+import sys
+import csv
+import bhl_store
+
+def join(in_name, out_name, db):
+    #
+    #  Copy the segments file, adding the stored identifiers to each row. Returns the number of rows read and matched.
+    #
+    columns = bhl_store.get_columns(db)
+    rows = matched = 0
+    with open(in_name, newline='', encoding='utf-8') as fin, open(out_name, 'w', newline='', encoding='utf-8') as fout:
+        reader = csv.reader(fin, dialect='excel-tab')
+        writer = csv.writer(fout, dialect='excel-tab')
+        heading = next(reader, None)
+        if heading is None:
+            return rows, matched
+        part_col = heading.index('Part ID') if 'Part ID' in heading else None
+        page_col = heading.index('Start Page BHL ID') if 'Start Page BHL ID' in heading else None
+        added = [col for col in columns if col not in heading]     # Columns already in the file are not repeated
+        writer.writerow(heading + added)
+        for row in reader:
+            rows += 1
+            values = None
+            if part_col is not None and part_col < len(row) and row[part_col].strip():
+                values = bhl_store.find_part(db, row[part_col].strip())
+            if values is None and page_col is not None and page_col < len(row) and row[page_col].strip():
+                values = bhl_store.find_page(db, row[page_col].strip())
+            if values is not None:
+                matched += 1
+            else:
+                values = {}
+            writer.writerow(row + [values.get(col,'') for col in added])
+    return rows, matched
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or not os.path.exists(sys.argv[1]):
+        print('Usage: python bhl_join.py segments.tsv [output.tsv]')
+        exit()
+    if not os.path.exists(bhl_store.store_file):
+        print('No identifier store found. Run BioStorID.py first to create ' + bhl_store.store_file)
+        exit()
+    in_name = sys.argv[1]
+    out_name = sys.argv[2] if len(sys.argv) > 2 else os.path.splitext(in_name)[0] + '_ids.tsv'
+    db = bhl_store.opn_store()
+    rows, matched = join(in_name, out_name, db)
+    db.close()
+    print(f'{matched} of {rows} rows matched. Output written to {out_name}')
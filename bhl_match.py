@@ -0,0 +1,142 @@
+#
+# Fuzzy matching of article metadata (e.g. from Crossref) to existing BHL parts. Used by cr2bhl.py.
+#
+#  All BHL part titles for a title are indexed once as sets of character trigrams. Each article is compared only with the parts
+#  that share its rarest trigrams, or that are in the same volume and start within page_tolerance pages of it. Candidates
+#  are scored by title similarity (Dice coefficient of the trigram sets) together with agreement of volume, start page and year.
+#  The score is between 0 and 1; exactly matching metadata scores 1. A volume, page or year missing on either side counts as a
+#  disagreement, so a title alone scores at most weights['title'] and a recurring title (e.g. "Book reviews") is not matched to a
+#  part of another volume. A part is never matched without a title on both sides, or when both start pages are known and more than
+#  page_tolerance pages apart. match_all() matches a batch of articles, e.g. one Crossref page, scoring repeated articles once.
+#
+#  Sample use
+#    index = bhl_match.PartIndex()
+#    index.add('12345', 'On some butterflies', '7', '113', '1921')
+#    part_id, score = index.match('On some butterflies.', '7', '113', '1921')
+#    matches = index.match_all([('On some butterflies.', '7', '113', '1921'), ...])
+#
+#  Load needed libraries
+#
+import re
+from collections import Counter
+from itertools import chain
+#
+# Global variables
+#
+ngram = 3                  # Length of the character n-grams compared
+page_tolerance = 2         # Start pages this far apart still count as a partial page match
+year_tolerance = 1         # Years this far apart still count as a partial year match
+max_candidates = 10        # Number of best title candidates scored in full for each article
+probe_grams = 8            # Number of the rarest n-grams of an article title used to find candidates
+weights = {'title': 0.6, 'volume': 0.2, 'page': 0.15, 'year': 0.05}   # Weight of each field in the score
+
+norm_re = re.compile(r'[\W_]+')     # Runs of punctuation and white space are ignored when titles are compared
+num_re = re.compile(r'\d+')
+
+def norm_title(title):
+    #
+    # Normalize a title for comparison: lower case, with punctuation and repeated white space removed.
+    #
+    return norm_re.sub(' ',title.lower()).strip()
+
+def grams(title):
+    #
+    # Return the set of character n-grams of a normalized title. The title is padded so short words still produce n-grams.
+    #
+    title = ' ' + title + ' '
+    return frozenset(title[i:i+ngram] for i in range(len(title)-ngram+1))
+
+def to_int(value):
+    #
+    # Return the first number in a volume, page or date string, or None
+    #
+    mtch = num_re.search(str(value or ''))
+    return int(mtch.group(0)) if mtch else None
+
+class PartIndex:
+    #
+    # N-gram index of the BHL parts of one title
+    #
+    def __init__(self):
+        self.part_ids = []        # Parallel lists. Position in the lists is the part number used in the index.
+        self.title_grams = []
+        self.volumes = []
+        self.spages = []
+        self.years = []
+        self.postings = {}        # Key is an n-gram. Other field is the list of part numbers whose titles contain it.
+        self.by_volume = {}       # Key is the volume. Other field is the list of part numbers in that volume.
+
+    def add(self, part_id, title, volume, spage, year):
+        #
+        # Add one BHL part to the index
+        #
+        num = len(self.part_ids)
+        tgrams = grams(norm_title(title or ''))
+        self.part_ids.append(part_id)
+        self.title_grams.append(tgrams)
+        self.volumes.append(str(volume or ''))
+        self.spages.append(to_int(spage))
+        self.years.append(to_int(year))
+        for gram in tgrams:
+            self.postings.setdefault(gram,[]).append(num)
+        self.by_volume.setdefault(str(volume or ''),[]).append(num)
+
+    def candidates(self, qgrams, volume, spage):
+        #
+        # Return the part numbers worth scoring for one article: the parts sharing the most of the rarest n-grams of its title,
+        # and the parts in the same volume starting near the same page.
+        #
+        lists = sorted((self.postings[gram] for gram in qgrams if gram in self.postings), key=len)
+        shared = Counter(chain.from_iterable(lists[:probe_grams]))
+        found = {num for num, count in shared.most_common(max_candidates)}
+        if volume and spage is not None:
+            for num in self.by_volume.get(volume,[]):
+                if self.spages[num] is not None and abs(self.spages[num] - spage) <= page_tolerance:
+                    found.add(num)
+        return found
+
+    def score(self, num, qgrams, volume, spage, year):
+        #
+        # Score one part against one article. Volume, page and year missing on either side add nothing to the score. A missing
+        # title or start pages further apart than page_tolerance score 0.
+        #
+        if not qgrams or not self.title_grams[num]:
+            return 0.0
+        if spage is not None and self.spages[num] is not None and abs(spage - self.spages[num]) > page_tolerance:
+            return 0.0
+        total = weights['title'] * 2 * len(qgrams & self.title_grams[num]) / (len(qgrams) + len(self.title_grams[num]))
+        if volume and self.volumes[num]:
+            total += weights['volume'] * (volume == self.volumes[num])
+        if spage is not None and self.spages[num] is not None:
+            total += weights['page'] * max(0.0, 1 - abs(spage - self.spages[num]) / (page_tolerance + 1))
+        if year is not None and self.years[num] is not None:
+            total += weights['year'] * max(0.0, 1 - abs(year - self.years[num]) / (year_tolerance + 1))
+        return total / sum(weights.values())
+
+    def match(self, title, volume='', spage='', year=''):
+        #
+        # Return the best matching part id and its score, or ('', 0.0) when the index holds no candidate
+        #
+        qgrams = grams(norm_title(title or '')) if title else frozenset()
+        volume = str(volume or '')
+        spage = to_int(spage)
+        year = to_int(year)
+        best_id, best_score = '', 0.0
+        for num in self.candidates(qgrams, volume, spage):
+            score = self.score(num, qgrams, volume, spage, year)
+            if score > best_score:
+                best_id, best_score = self.part_ids[num], score
+        return best_id, best_score
+
+    def match_all(self, articles):
+        #
+        # Match a batch of articles given as (title, volume, start page, year). Returns a list of (part id, score) in the same
+        # order. Articles with the same metadata are scored once.
+        #
+        found = {}
+        results = []
+        for article in articles:
+            if article not in found:
+                found[article] = self.match(*article)
+            results.append(found[article])
+        return results
@@ -0,0 +1,189 @@
+#
+# Compact index of BHL page level metadata. Used by toc_plmd.py.
+#
+#  Pages are kept in parallel arrays, one entry per page, in the order BHL lists the pages of each item (the sequence order), so a
+#  title of 100k+ pages takes a few MB instead of one dictionary per page. Repeated strings (page prefixes and numbers, volume,
+#  issue and year) are stored once. Pages are looked up by (item id, prefix, number). Every page number of a page is indexed and
+#  a number found on more than one page (plates, several issues in one item, roman numeral front matter) returns all of those
+#  pages in sequence order instead of keeping only the last one. Rows of an item are contiguous, so the pages from a start page to
+#  the page before the next article are a range of rows. The index can be saved to and loaded from a json file.
+#
+#  Sample use
+#    index = bhl_pages.PageIndex()
+#    index.add_item(pages)                       # The page records of one item from GetItemMetadata
+#    rows = index.find(itemid, '12')             # Rows of page 12 of the item, in sequence order
+#    index.page(rows[0]).pageid
+#
+#  Load needed libraries
+#
+import sys
+import json
+import base64
+import threading
+import bhl_files
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import namedtuple
+
+Page = namedtuple('Page', 'itemid seq prefix number pageid vol issue year toc')
+
+class PageIndex:
+    columns = ('itemid', 'pageid', 'prefix', 'number', 'vol', 'issue', 'year', 'toc', 'keys', 'key_rows')   # Arrays saved by to_dict
+
+    def __init__(self):
+        self.strings = ['']            # Distinct strings. The arrays below hold positions in this list.
+        self.string_ids = {'': 0}
+        self.itemid = array('q')
+        self.pageid = array('q')
+        self.prefix = array('i')       # Prefix and number shown for the page: the Page number if there is one
+        self.number = array('i')
+        self.vol = array('i')
+        self.issue = array('i')
+        self.year = array('i')
+        self.toc = array('b')          # 1 for pages marked as Table of Contents
+        self.keys = array('q')         # Lookup keys (prefix, number) of the pages of each item, sorted within the item
+        self.key_rows = array('i')     # Row of each lookup key
+        self.items = {}                # Key is the item id. Other fields are the first and end row of the item and of its keys.
+        self.lock = threading.Lock()   # Items may be added by several worker threads
+
+    def __len__(self):
+        return len(self.pageid)
+
+    def intern(self, text):
+        #
+        # Return the position of a string in strings, adding it if needed. Called with the lock held.
+        #
+        text = str(text or '')
+        pos = self.string_ids.get(text)
+        if pos is None:
+            pos = self.string_ids[text] = len(self.strings)
+            self.strings.append(text)
+        return pos
+
+    def add_item(self, pages):
+        #
+        # Add the page records of one item, as returned by GetItemMetadata with pages=t. The records may be read one at a time, e.g.
+        # from bhl_stream. The rows of the item are built as each record arrives, with strings kept in a table of the item's own,
+        # so only the rows and not the records are held until they are added. Returns the number of pages added.
+        #
+        strings, string_ids = [], {}
+        def local(text):
+            text = str(text or '')
+            pos = string_ids.get(text)
+            if pos is None:
+                pos = string_ids[text] = len(strings)
+                strings.append(text)
+            return pos
+        itemid, pageid = array('q'), array('q')
+        prefix, number, vol, issue, year = array('i'), array('i'), array('i'), array('i'), array('i')
+        toc = array('b')
+        key_prefix, key_number, key_seq = array('i'), array('i'), array('i')   # Lookup keys of the item: prefix, number and page
+        for seq, page in enumerate(pages):
+            numbers = [(num.get('Prefix') or '', num.get('Number') or '') for num in page.get('PageNumbers') or []]
+            shown = next((num for num in numbers if num[0] == 'Page'), numbers[0] if numbers else ('',''))
+            itemid.append(page['ItemID'])
+            pageid.append(page['PageID'])
+            prefix.append(local(shown[0]))
+            number.append(local(shown[1]))
+            vol.append(local(page.get('Volume')))
+            issue.append(local(page.get('Issue')))
+            year.append(local(page.get('Year')))
+            toc.append(any(ptype.get('PageTypeName') == 'Table of Contents' for ptype in page.get('PageTypes') or []))
+            for num_prefix, num_number in set(numbers):
+                key_prefix.append(local(num_prefix))
+                key_number.append(local(num_number))
+                key_seq.append(seq)
+        if not pageid:
+            return 0
+        with self.lock:
+            ids = array('i', (self.intern(text) for text in strings))   # Position in strings of each string of the item
+            first, key_first = len(self.pageid), len(self.keys)
+            self.itemid.extend(itemid)
+            self.pageid.extend(pageid)
+            for name, column in (('prefix', prefix), ('number', number), ('vol', vol), ('issue', issue), ('year', year)):
+                getattr(self, name).extend(ids[pos] for pos in column)
+            self.toc.extend(toc)
+            keys = sorted((ids[key_prefix[pos]] << 32 | ids[key_number[pos]], first + key_seq[pos]) for pos in range(len(key_seq)))
+            self.keys.extend(key for key, row in keys)
+            self.key_rows.extend(row for key, row in keys)
+            self.items[itemid[0]] = (first, len(self.pageid), key_first, len(self.keys))
+        return len(pageid)
+
+    def find(self, itemid, number, prefix='Page'):
+        #
+        # Return the rows of the pages of an item with this prefix and number, in sequence order
+        #
+        if itemid not in self.items or prefix not in self.string_ids or number not in self.string_ids:
+            return []
+        first, end, key_first, key_end = self.items[itemid]
+        key = self.string_ids[prefix] << 32 | self.string_ids[number]
+        return list(self.key_rows[bisect_left(self.keys, key, key_first, key_end):bisect_right(self.keys, key, key_first, key_end)])
+
+    def page(self, row):
+        #
+        # Return the record of the page in a row
+        #
+        first = self.items[self.itemid[row]][0]
+        return Page(self.itemid[row], row - first, self.strings[self.prefix[row]], self.strings[self.number[row]], self.pageid[row],
+                    self.strings[self.vol[row]], self.strings[self.issue[row]], self.strings[self.year[row]], bool(self.toc[row]))
+
+    def rows(self, itemid):
+        #
+        # Return the rows of an item, in sequence order
+        #
+        first, end = self.items.get(itemid, (0, 0))[:2]
+        return range(first, end)
+
+    def last_numbered(self, first_row, end_row, prefix='Page'):
+        #
+        # Return the last row before end_row, and not before first_row, of a page numbered with this prefix, or None
+        #
+        pos = self.string_ids.get(prefix)
+        for row in range(end_row - 1, first_row - 1, -1):
+            if self.prefix[row] == pos and self.number[row]:
+                return row
+        return None
+
+    def span(self, first_row, end_row):
+        #
+        # Return the page ids of the rows from first_row up to but not including end_row, e.g. the pages of an article
+        #
+        return list(self.pageid[first_row:end_row])
+
+    def toc_pages(self, itemid):
+        #
+        # Return the page ids of the pages of an item marked as Table of Contents
+        #
+        return [self.pageid[row] for row in self.rows(itemid) if self.toc[row]]
+
+    def to_dict(self):
+        #
+        # Return the index as a dictionary for saving as json. Arrays are stored as base64 text of their bytes.
+        #
+        return {'byteorder':sys.byteorder, 'strings':self.strings, 'items':[[itemid] + list(pos) for itemid, pos in self.items.items()],
+                **{name:base64.b64encode(getattr(self, name).tobytes()).decode('ascii') for name in self.columns}}
+
+    @classmethod
+    def from_dict(cls, data):
+        index = cls()
+        index.strings = data['strings']
+        index.string_ids = {text: pos for pos, text in enumerate(index.strings)}
+        index.items = {crnt[0]: tuple(crnt[1:]) for crnt in data['items']}
+        for name in cls.columns:
+            crnt = getattr(index, name)
+            crnt.frombytes(base64.b64decode(data[name]))
+            if data['byteorder'] != sys.byteorder:
+                crnt.byteswap()
+        return index
+
+    def save(self, fname):
+        #
+        # Write the index to a json file
+        #
+        with bhl_files.replace_file(fname) as fh:
+            json.dump(self.to_dict(), fh, separators=(',',':'))
+
+    @classmethod
+    def load(cls, fname):
+        with open(fname, encoding='utf-8') as fh:
+            return cls.from_dict(json.load(fh))
@@ -0,0 +1,182 @@
+#
+# Request instrumentation and progress reporting for BioStorID.py, cr2bhl.py and toc_plmd.py.
+#
+#  Every outbound request is recorded under its operation: the API3 op (e.g. GetPartMetadata), openurl or works (Crossref).
+#  For each operation the number of requests, a latency histogram, bytes received, errors, retries and cache hits are kept.
+#  When the program exits, a summary is written to summary_file as json and, if prom_file is set (or the BHL_PROM_FILE
+#  environment variable), in the Prometheus textfile format. A one line progress report with an estimated time to completion
+#  is available through the Progress class. Worker processes, which do not run exit handlers, hand their counters to the parent
+#  with take() and the parent adds them to its own with merge().
+#
+#  Sample use
+#    start = time.monotonic()
+#    ... call the API ...
+#    bhl_stats.record('GetPartMetadata', time.monotonic() - start, len(mydata))
+#
+#  Load needed libraries
+#
+import os
+import sys
+import json
+import time
+import atexit
+import threading
+import bhl_files
+#
+# Global variables
+#
+summary_file = 'bhl_stats.json'                     # Json summary written at exit. Empty string: no summary.
+prom_file = os.environ.get('BHL_PROM_FILE','')      # Prometheus textfile written at exit. Empty string: no textfile.
+buckets = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)  # Upper bounds of the latency histogram buckets, in seconds
+
+stats = {}           # Key is the operation. Other field is a dictionary of counters.
+lock = threading.Lock()
+started = time.time()
+
+def new_op():
+    return {'requests':0, 'errors':0, 'retries':0, 'cache_hits':0, 'bytes':0, 'seconds':0.0, 'buckets':[0]*(len(buckets)+1)}
+
+def record(op, seconds, nbytes=0, error=False):
+    #
+    # Record one request sent to a server. seconds is the time taken and nbytes the size of the response.
+    #
+    with lock:
+        crnt = stats.setdefault(op, new_op())
+        crnt['requests'] += 1
+        crnt['seconds'] += seconds
+        crnt['bytes'] += nbytes
+        if error:
+            crnt['errors'] += 1
+        pos = 0
+        while pos < len(buckets) and seconds > buckets[pos]:
+            pos += 1
+        crnt['buckets'][pos] += 1
+
+def record_retry(op):
+    #
+    # Record that a request is being sent again after a failure
+    #
+    with lock:
+        stats.setdefault(op, new_op())['retries'] += 1
+
+def record_hit(op):
+    #
+    # Record a request answered from the response cache
+    #
+    with lock:
+        stats.setdefault(op, new_op())['cache_hits'] += 1
+
+def take():
+    #
+    # Return the counters recorded so far and start again from zero
+    #
+    with lock:
+        crnt = dict(stats)
+        stats.clear()
+        return crnt
+
+def merge(ops):
+    #
+    # Add counters returned by take() in another process to the counters of this one
+    #
+    with lock:
+        for op, counts in ops.items():
+            crnt = stats.setdefault(op, new_op())
+            for key, val in counts.items():
+                if key == 'buckets':
+                    crnt[key] = [total + count for total, count in zip(crnt[key], val)]
+                else:
+                    crnt[key] += val
+
+def summary():
+    #
+    # Return the counters for every operation, with the histogram buckets labelled by their upper bound
+    #
+    with lock:
+        ops = {}
+        for op, crnt in sorted(stats.items()):
+            ops[op] = dict(crnt, buckets=dict(zip([str(b) for b in buckets] + ['+Inf'], crnt['buckets'])),
+                           avg_seconds=round(crnt['seconds'] / crnt['requests'], 4) if crnt['requests'] else 0.0)
+        return {'program': os.path.basename(sys.argv[0]), 'elapsed_seconds': round(time.time() - started, 3), 'operations': ops}
+
+def wrt_prometheus(fname, smry):
+    #
+    # Write the counters in the Prometheus textfile format
+    #
+    lines = []
+    for name, kind, text in (('bhl_requests_total', 'counter', 'Requests sent'), ('bhl_request_errors_total', 'counter', 'Failed requests'),
+                             ('bhl_request_retries_total', 'counter', 'Requests sent again'), ('bhl_cache_hits_total', 'counter', 'Requests answered from the cache'),
+                             ('bhl_response_bytes_total', 'counter', 'Bytes received'), ('bhl_request_seconds', 'histogram', 'Request latency')):
+        lines.append(f'# HELP {name} {text}')
+        lines.append(f'# TYPE {name} {kind}')
+        for op, crnt in smry['operations'].items():
+            label = f'op="{op}",program="{smry["program"]}"'
+            if kind == 'histogram':
+                total = 0
+                for bound, count in crnt['buckets'].items():
+                    total += count
+                    lines.append(f'{name}_bucket{{{label},le="{bound}"}} {total}')
+                lines.append(f'{name}_sum{{{label}}} {crnt["seconds"]:.6f}')
+                lines.append(f'{name}_count{{{label}}} {crnt["requests"]}')
+            else:
+                field = {'bhl_requests_total':'requests', 'bhl_request_errors_total':'errors', 'bhl_request_retries_total':'retries',
+                         'bhl_cache_hits_total':'cache_hits', 'bhl_response_bytes_total':'bytes'}[name]
+                lines.append(f'{name}{{{label}}} {crnt[field]}')
+    with bhl_files.replace_file(fname) as fh:
+        fh.write('\n'.join(lines) + '\n')
+
+def wrt_summary():
+    #
+    # Write the json summary and the Prometheus textfile. Registered to run at exit.
+    #
+    if not stats:
+        return
+    smry = summary()
+    if summary_file:
+        with open(summary_file, 'w', encoding='utf-8') as fh:
+            json.dump(smry, fh, indent=2)
+    if prom_file:
+        wrt_prometheus(prom_file, smry)
+
+atexit.register(wrt_summary)
+
+class Progress:
+    #
+    # One line progress report: work done, work known so far, rate and estimated time to completion. The total may grow while
+    # the program runs, e.g. when the parts of an item become known. The line is redrawn at most every interval seconds.
+    #
+    def __init__(self, label, total=0, interval=0.5):
+        self.label = label
+        self.total = total
+        self.done = 0
+        self.interval = interval
+        self.start = time.monotonic()
+        self.shown = 0.0
+        self.lock = threading.Lock()
+
+    def add_total(self, count):
+        with self.lock:
+            self.total += count
+
+    def step(self, count=1):
+        with self.lock:
+            self.done += count
+            now = time.monotonic()
+            if now - self.shown >= self.interval or self.done >= self.total:
+                self.shown = now
+                self.show(now)
+
+    def show(self, now):
+        elapsed = now - self.start
+        rate = self.done / elapsed if elapsed > 0 else 0.0
+        eta = '?'
+        if rate > 0 and self.total >= self.done:
+            secs = int((self.total - self.done) / rate)
+            eta = f'{secs // 3600}:{secs // 60 % 60:02d}:{secs % 60:02d}'
+        sys.stdout.write(f'\r{self.done}/{self.total} {self.label}, {rate:.1f}/s, ETA {eta}   ')
+        sys.stdout.flush()
+
+    def close(self):
+        with self.lock:
+            self.show(time.monotonic())
+        sys.stdout.write('\n')
@@ -0,0 +1,67 @@
+#
+# Local lookup store of BHL part identifiers, written by BioStorID.py and read by bhl_join.py.
+#
+#  Parts are kept in a SQLite table keyed by part id, with the start page id indexed, so one identifier lookup takes a single
+#  index probe however many parts are stored. Writing a part that is already stored replaces its values (upsert), so running
+#  BioStorID.py again for a title, or for several titles, keeps one row per part. The names of the identifier columns are
+#  saved with the parts, in the order BioStorID.py writes them.
+#
+#  Sample use
+#    db = bhl_store.opn_store()
+#    bhl_store.upsert(db, titleid, rows, columns)
+#    values = bhl_store.find_part(db, part_id)
+#
+#  Load needed libraries
+#
+import json
+import time
+import sqlite3
+#
+# Global variables
+#
+store_file = 'bhl_store.sqlite'       # SQLite database that holds the parts
+
+def opn_store(fname=None):
+    #
+    #  Open the store, creating it if needed
+    #
+    db = sqlite3.connect(fname or store_file, timeout=60)
+    db.execute('CREATE TABLE IF NOT EXISTS parts (part_id TEXT PRIMARY KEY, title_id TEXT, start_page_id TEXT, ids TEXT, updated REAL)')
+    db.execute('CREATE INDEX IF NOT EXISTS parts_start_page ON parts (start_page_id)')
+    db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+    return db
+
+def get_columns(db):
+    #
+    #  Return the names of the stored identifier columns
+    #
+    row = db.execute("SELECT value FROM meta WHERE key = 'columns'").fetchone()
+    return json.loads(row[0]) if row else []
+
+def upsert(db, titleid, rows, columns, start_page='Start page id'):
+    #
+    #  Store the parts of one title. rows holds (part id, values) pairs where values is a dictionary keyed by column name.
+    #  The start page id is taken from the start_page column.
+    #
+    now = time.time()
+    names = get_columns(db)
+    names += [col for col in columns if col not in names]   # Columns of earlier runs are kept, new ones added at the end
+    db.execute("INSERT OR REPLACE INTO meta VALUES ('columns', ?)", (json.dumps(names),))
+    db.executemany('INSERT INTO parts VALUES (?, ?, ?, ?, ?) ON CONFLICT (part_id) DO UPDATE SET '
+                   'title_id = excluded.title_id, start_page_id = excluded.start_page_id, ids = excluded.ids, updated = excluded.updated',
+                   ((str(part_id), str(titleid), str(values.get(start_page,'')), json.dumps(values), now) for part_id, values in rows))
+    db.commit()
+
+def find_part(db, part_id):
+    #
+    #  Return the values stored for a part id, or None
+    #
+    row = db.execute('SELECT ids FROM parts WHERE part_id = ?', (str(part_id),)).fetchone()
+    return json.loads(row[0]) if row else None
+
+def find_page(db, pageid):
+    #
+    #  Return the values stored for the part that starts on a page id, or None
+    #
+    row = db.execute('SELECT ids FROM parts WHERE start_page_id = ? ORDER BY updated DESC', (str(pageid),)).fetchone()
+    return json.loads(row[0]) if row else None
@@ -0,0 +1,208 @@
+#
+# Streaming reader for large BHL API3 responses. Used by BioStorID.py, cr2bhl.py and toc_plmd.py.
+#
+#  A GetTitleMetadata response with thousands of items, or a GetItemMetadata response with thousands of pages, is not read
+#  into memory at once. The response is decoded a chunk at a time and the records of one array, e.g. Result[0].Items, are
+#  returned one by one as soon as each is complete. Only the record being decoded and the current chunk are held in memory.
+#  Fields of the outer object that come before the array, such as Status, are kept in the fields dictionary.
+#
+#  open_records() reads a BHL URL through bhl_cache. If the connection is lost while the response is read, the request is sent
+#  again (with the backoff of bhl_client) and reading continues after the records already returned.
+#
+#  Sample use
+#    records = bhl_stream.open_records(url, ('Result', 0, 'Items'))
+#    if records.fields.get('Status') != 'ok':
+#        ...
+#    for item in records:
+#        ...
+#
+#  Load needed libraries
+#
+import time
+import json
+import codecs
+import http.client
+import urllib.error
+import bhl_cache
+import bhl_client
+import bhl_stats
+
+chunk_size = 65536
+decoder = json.JSONDecoder()
+space = ' \t\r\n'
+
+class Records:
+    #
+    # Iterate over the records of the array found at path (object keys and array positions) in a json stream
+    #
+    def __init__(self, stream, path):
+        self.stream = stream
+        self.text = codecs.getincrementaldecoder('utf-8')()
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+        self.fields = {}          # Fields of the outer object read before the array
+        self.found = self.find(path)
+
+    def fill(self):
+        #
+        # Read the next chunk. Text already consumed is dropped. Returns False at the end of the stream.
+        #
+        if self.eof:
+            return False
+        data = self.stream.read(chunk_size)
+        self.buf = self.buf[self.pos:] + self.text.decode(data, final=not data)
+        self.pos = 0
+        if not data:
+            self.eof = True
+            self.stream.close()
+        return True
+
+    def peek(self):
+        #
+        # Skip white space and return the next character, or '' at the end of the stream
+        #
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in space:
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self.fill():
+                return ''
+
+    def expect(self, chars):
+        #
+        # Consume the next character if it is one of chars. Returns the character, or '' if something else comes next.
+        #
+        ch = self.peek()
+        if ch and ch in chars:
+            self.pos += 1
+            return ch
+        return ''
+
+    def value(self):
+        #
+        # Decode one complete json value, reading more of the stream until it is complete
+        #
+        self.peek()
+        while True:
+            try:
+                val, end = decoder.raw_decode(self.buf, self.pos)
+                if end < len(self.buf) or self.eof:     # A number at the end of the buffer may continue in the next chunk
+                    self.pos = end
+                    return val
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self.fill()
+
+    def find(self, path):
+        #
+        # Move to the start of the array at path. Returns False if the path is not in the stream.
+        #
+        top = True
+        for step in path:
+            if isinstance(step, int):
+                if not self.expect('['):
+                    return False
+                for num in range(step):
+                    if self.peek() == ']':
+                        return False
+                    self.value()
+                    self.expect(',')
+                if self.peek() == ']':
+                    return False
+            else:
+                if not self.expect('{'):
+                    return False
+                while self.peek() == '"':
+                    key = self.value()
+                    self.expect(':')
+                    if key == step:
+                        break
+                    val = self.value()
+                    if top:
+                        self.fields[key] = val
+                    self.expect(',')
+                else:
+                    return False
+            top = False
+        if self.peek() != '[':
+            return False
+        self.pos += 1
+        return True
+
+    def __iter__(self):
+        if self.found:
+            while self.peek() not in (']', ''):
+                yield self.value()
+                self.expect(',')
+        self.drain()
+
+    def drain(self):
+        #
+        # Read the rest of the stream, so a response is complete and can be stored in the cache
+        #
+        while self.fill():
+            self.pos = len(self.buf)
+
+    def close(self):
+        if not self.eof:
+            self.eof = True
+            self.stream.close()
+
+class RetryRecords:
+    #
+    # Records of a BHL URL, read again from the start when the connection is lost. Records already returned are skipped.
+    #
+    def __init__(self, url, path, refresh=False):
+        self.url = url
+        self.path = path
+        self.refresh = refresh
+        self.attempt = 0
+        self.records = self.open()
+        self.fields = self.records.fields
+        self.found = self.records.found
+
+    def retry(self, err):
+        #
+        # Wait before the next attempt, or raise the error when all attempts have been used
+        #
+        if self.attempt >= bhl_client.max_retries or isinstance(err, urllib.error.URLError):   # bhl_client has already retried
+            raise err
+        time.sleep(bhl_client.retry_wait(self.attempt, None))
+        self.attempt += 1
+        bhl_stats.record_retry(bhl_client.op_name(self.url))
+
+    def open(self):
+        while True:
+            try:
+                return Records(bhl_cache.open_url(self.url, refresh=self.refresh), self.path)
+            except (OSError, http.client.HTTPException) as err:    # Connection lost before the array was reached
+                self.retry(err)
+
+    def __iter__(self):
+        done = 0
+        while True:
+            try:
+                skip = done
+                for record in self.records:
+                    if skip:
+                        skip -= 1
+                        continue
+                    done += 1
+                    yield record
+                return
+            except (OSError, http.client.HTTPException) as err:    # Connection lost while the records were read
+                self.records.close()
+                self.retry(err)
+                self.records = self.open()
+
+    def close(self):
+        self.records.close()
+
+def open_records(url, path, refresh=False):
+    #
+    # Return the records of the array at path in the response to a BHL URL, read through bhl_cache with retries
+    #
+    return RetryRecords(url, path, refresh)
@@ -1,32 +1,66 @@
 #
-# This code, written in python 3, uses the Crossref REST API and the crossrefapi python library. Both are well documented
-# in the readme files of their GitHub repos. You will need to install the crossrefapi library prior to running this program.
+# This code, written in python 3, uses the Crossref REST API, which is well documented in the readme file of its GitHub repo.
 # The code has been tested from the Mac command line. The code does the following:
 #
 # - Prompts the user for an ISSN, starting year, ending year and prefix for the output tsv file.
 # - Pulls all article metadata from Crossref for the specified journal and date range
 # - Formats the metadata into a tsv file that conforms to the input requirements of the BHL Import Segments function
+#
+# Crossref results are read one page at a time using a Crossref cursor. After each page is written, a checkpoint file (the output
+# file name followed by .ckpt) records the cursor, the number of rows written and the BHL item ids. If the run is interrupted, run
+# the program again with the same input: it continues from the last completed page and appends to the existing tsv file. The
+# checkpoint file is removed when the run completes.
+#
+# The BHL and Crossref addresses may be changed with the BHL_URL and CROSSREF_URL environment variables, e.g. to run against the
+# local stub server in benchmarks/.
 # 
 # Please note that you will need to acquire a BHL API key and set the BHL_key variable to that value in file config.py
 # The procedure for getting a key is described at https://about.biodiversitylibrary.org/tools-and-services/developer-and-data-tools/
 # Please note that the output tsv file may require substantial editing before being used to define articles in BHL.
 # Please verify that the BHL title record includes an ISSN identifier before running this code. The code can find BHL item id when the volume 
-# enumeration value in the item record follows current standards. It can not determine item ids when the enumeration data differs significantly
-# from current standards. The code will optionally attempt to match articles in Crossref with existing articles in BHL using openURL. Note that this
-# is a slow process.
+# enumeration value in the item record follows current standards (see bhl_enum.py). It can not determine item ids when the enumeration data differs
+# significantly from current standards. The code will optionally attempt to match articles in Crossref with existing articles in BHL. All BHL parts for the
+# title are read once (one request per item) and indexed by volume and starting page and by title, so each Crossref article is matched with
+# a dictionary lookup. Articles without an exact match are matched by title similarity and nearby volume, page and year (see bhl_match.py).
+# The Match Score column holds the confidence of the match, from 0 to 1.
+# Existing BHL articles are read by up to max_workers concurrent requests. Crossref pages are read ahead in a separate thread
+# while earlier pages are matched and written, so a slow Crossref response and the matching overlap.
 #
 #  Import needed libraries
 #
-from crossref.restful import Works
-from crossref.restful import Journals
 import re
+import os
 import csv
 import urllib.parse
-import urllib.request
+import urllib.error
 import json
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import bhl_cache
+import bhl_stream
+import bhl_client
+import bhl_stats
+import bhl_match
+import bhl_enum
+import bhl_files
 from config import BHL_key
 
-BHL_items = {}       # Build dictionary. Key is volume number.  The other field is the item id.
+BHL_items = bhl_enum.ItemIndex()   # BHL items indexed by series, volume, issue and year
+BHL_item_ids = []    # All BHL item ids for the title in the order returned by BHL
+BHL_parts = {}       # Existing BHL articles. Key is (volume, start page). Other field is a list of (normalized title, part id).
+BHL_part_titles = {} # Existing BHL articles. Key is normalized title. Other field is a list of (volume, start page, part id).
+BHL_match = bhl_match.PartIndex()   # N-gram index of existing BHL articles used when there is no exact match
+match_score = 0.8    # Inexact matches scoring below this are not reported
+service_url = os.environ.get('BHL_URL','https://www.biodiversitylibrary.org/') + 'api3?'
+crossref_url = os.environ.get('CROSSREF_URL','https://api.crossref.org/works') + '?'
+rows_per_page = 1000  # Number of Crossref records requested per page. 1000 is the maximum allowed by Crossref.
+max_workers = 8      # Maximum number of concurrent requests sent to BHL when reading existing articles
+queue_pages = 2      # Crossref pages held between pipeline stages (see run_journal)
+end_marker = object()   # Last entry put on a pipeline queue
+stage_wait = 0.5     # Seconds a pipeline stage waits on a queue before checking whether the pipeline has been stopped
+title_cache = {}     # BHL item and part lookups already built in this process. Key is ISSN. Reused when the same journal is run again.
+parts_read = set()   # ISSNs whose existing BHL articles are already in title_cache
 
 
 def get_input ():
@@ -72,53 +106,31 @@ def auth_collect(auth_in):
     
 def read_items_BHL():
     #
-    # Gather BHL item ids and build dictionary. Key is the volume number. Other field is BHL item id. Note that the code is successful only when
-    # volume enumeration from the item record follows current standards. The presence of series in the enumeration data is not handled.
+    # Gather BHL item ids and build the BHL_items index. Note that the code is successful only when volume enumeration from the item
+    # record follows current standards.
     #
-    service_url = 'https://www.biodiversitylibrary.org/api3?'
     
     #
     # Prepare the search command and then call the API. If problems occur, one or more BHL item ids will be missing from the output spreadsheet.
     url=service_url + urllib.parse.urlencode({'op':'GetTitleMetadata','format':'json','id':issn,'idtype':'issn','items':'t','apikey':BHL_key})
     #print(url)
-    uh=urllib.request.urlopen(url)
-    mydata=uh.read().decode('utf-8')
-    resp=json.loads(mydata)
+    items = bhl_stream.open_records(url, ('Result', 0, 'Items'))   # Items are read one at a time as the response arrives
 
-    if 'Status' not in resp or resp['Status'] != 'ok' or len(resp['Result']) == 0:   # Were items successfully read from the BHL database?
+    if items.fields.get('Status') != 'ok':   # Were items successfully read from the BHL database?
+        items.close()
         return
-    for item in resp['Result'][0]['Items']:   # Process each BHL item returned
+    for item in items:   # Process each BHL item returned
         itemID = item['ItemID']
-        enum = item['Volume']                # Locate enumeration string
-        mtch= re.search('v\.([\d\-\s]+)[=\(]',enum)    # Locate the  volume number(s)
-        if mtch == None:
-            continue
-        try:
-            volumes = mtch.group(1).strip()
-            mtch = re.fullmatch('\d+',volumes)          # Single volume number?
-            if mtch != None:
-                BHL_items[mtch.group(0)] = itemID       # enumeration string contains a single volume number
-            else:
-                mtch = re.fullmatch('(\d+)-(\d+)',volumes) # Volume number range?
-                if None != mtch:
-                    strtvol = int(mtch.group(1))          # Convert start and end of range to integer format in order to iterate over range.
-                    endvol = int(mtch.group(2))
-                    for vol in range(strtvol,endvol+1):   # Process each volume number in volume number range
-                        BHL_items[str(vol)] = itemID
-        except:
-            pass
+        BHL_item_ids.append(itemID)
+        BHL_items.add(itemID, item['Volume'], item.get('Year',''))   # Parse the enumeration string and add the item to the index
         
     
-def wrt_art(amd):
+def art_row(amd):
     #
-    #  Write metadata for one article to the output file
+    #  Return the output row for one article: its metadata, BHL item id and, if asked for, the matching BHL part
     #
     #print(amd)
     aitemid = avolume = aissue = aauthors = atitle = adate = adoi = aspage = aepage = ''  # Initialize metadata variables to the empty string
-    try:
-        aitemid=BHL_items[amd['volume']]   # Use dictionary built from BHL contents to obtain BHL item id. Volume number is the key for dictionary lookup.
-    except:
-       pass
     try:
         aissue = amd['issue']
     except:
@@ -133,6 +145,14 @@ def wrt_art(amd):
            adate += f'-{date_part:02d}'
     except:
         pass
+    #
+    # Use the index built from BHL contents to obtain BHL item id. Volume, issue and year are used for the lookup. If no item
+    # matches all three, e.g. because the print date differs from the volume year, the volume alone is used. When several items
+    # hold the volume, lookup returns the most specific first (e.g. 'v.5:no.4' before a bound 'v.1-50' index).
+    #
+    items = BHL_items.lookup(avolume,aissue,adate[:4]) or BHL_items.lookup(avolume)
+    if items:
+        aitemid = items[0]
     try:
         adoi = amd['DOI']
     except:
@@ -154,63 +174,260 @@ def wrt_art(amd):
         aauthors = auth_collect(amd['author'])     
     except:
         pass
-    apart = ''
-    if chk_existing == 'y' or chk_existing == 'Y':   # Did user choose to match Crossref articles to existing BHL articles?
-        apart = defined_BHL(atitle,aspage,avolume)
-    writer.writerow((atitle,'',aitemid,avolume,aissue,'',adate,'',aauthors,aspage,aepage,'','','',adoi,apart))              # Write a row to the tsv file
+    return (atitle,'',aitemid,avolume,aissue,'',adate,'',aauthors,aspage,aepage,'','','',adoi)   # Part id and match score are added by match_page
 
-def defined_BHL(title,spage,vol):
+def get_parts_BHL(itemID):
     #
-    # Use openURL to search for matching, pre-existing article in BHL. If found, save part ID in output spreadsheet.
+    # Return the existing BHL articles of one item as (volume, start page, normalized title, part id, date) tuples. Runs in a
+    # worker thread.
     #
-    service_url = 'https://www.biodiversitylibrary.org/openurl?'
-    url=service_url + urllib.parse.urlencode({'title':title,'format':'json'})
+    url=service_url + urllib.parse.urlencode({'op':'GetItemMetadata','format':'json','id':itemID,'parts':'t','apikey':BHL_key})
     #print(url)
-    uh=urllib.request.urlopen(url)
-    mydata=uh.read().decode('utf-8')
-    resp=json.loads(mydata)
-    part_id = ''
+    parts = bhl_stream.open_records(url, ('Result', 0, 'Parts'))
+    if parts.fields.get('Status') != 'ok':   # If problems occur, articles in this item are not matched
+        parts.close()
+        return []
+    articles = []
+    for part in parts:
+        if part.get('Genre') != 'Article':
+            continue
+        articles.append((str(part.get('Volume') or ''), str(part.get('StartPageNumber') or ''), bhl_match.norm_title(part.get('Title') or ''),
+                         str(part['PartID']), part.get('Date')))
+    return articles
+
+def read_parts_BHL():
+    #
+    # Gather all existing BHL articles for the title and build the BHL_parts and BHL_part_titles dictionaries and the BHL_match
+    # index. Uses the item ids
+    # collected by read_items_BHL. One request is made per item instead of one openURL request per Crossref article. Up to
+    # max_workers items are requested at once; articles are added to the index in item order.
+    #
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        for articles in pool.map(get_parts_BHL, BHL_item_ids):
+            for vol, spage, title, part_id, date in articles:
+                BHL_parts.setdefault((vol,spage),[]).append((title,part_id))
+                BHL_part_titles.setdefault(title,[]).append((vol,spage,part_id))
+                BHL_match.add(part_id,title,vol,spage,date)
+
+def defined_BHL(articles):
+    #
+    # Search the BHL part index for matching, pre-existing articles in BHL. articles is a list of (title, start page, volume, year).
+    # Returns the part ID and match score of each article, saved in the output spreadsheet, or empty strings. An exact match has
+    # equal volume and starting page, and a title that is equal once normalized or that contains the other title. Exact matches
+    # score 1. The other articles are matched together by BHL_match and the best inexact match is returned when it scores at least
+    # match_score.
+    #
+    results = []
+    todo = []                # Articles without an exact match: position in results and (title, volume, start page, year)
+    for title, spage, vol, year in articles:
+        part_id = ''
+        title = bhl_match.norm_title(title)
+        for pvol, pspage, pid in BHL_part_titles.get(title,[]):   # Same title?
+            if (pvol == vol) & (pspage == spage):
+                part_id = pid
+        if part_id == '' and title:
+            for ptitle, pid in BHL_parts.get((vol,spage),[]):      # Same volume and starting page with a similar title?
+                if ptitle and (ptitle in title or title in ptitle):
+                    part_id = pid
+        if part_id:
+            results.append((part_id, '1.00'))
+        else:
+            results.append(('', ''))
+            todo.append((len(results) - 1, (title, vol, spage, year)))
+    for (pos, article), (part_id, score) in zip(todo, BHL_match.match_all([article for pos, article in todo])):
+        if score >= match_score:
+            results[pos] = (part_id, f'{score:.2f}')
+    return results
+
+def crossref_pages(cursor):
+    #
+    # Read article metadata from Crossref one page at a time. Yield the records on each page and the cursor for the next page.
+    #
+    while True:
+        url = crossref_url + urllib.parse.urlencode({'filter':'issn:'+issn+',from-pub-date:'+start_yr+',until-pub-date:'+end_yr,'sort':'issued',
+            'select':'title,DOI,volume,issue,page,author,published-print,type','rows':rows_per_page,'cursor':cursor})
+        #print(url)
+        mydata=bhl_client.get(url,'works')
+        resp=json.loads(mydata.decode('utf-8'))
+        if len(resp['message']['items']) == 0:   # No more records?
+            return
+        cursor = resp['message']['next-cursor']
+        progress.total = resp['message'].get('total-results', progress.total)
+        yield resp['message']['items'], cursor
+
+def put_stage(out_queue, crnt, stop):
+    #
+    # Put crnt on out_queue, waiting while the queue is full. Returns False if the pipeline is stopped first.
+    #
+    while not stop.is_set():
+        try:
+            out_queue.put(crnt, timeout=stage_wait)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+def run_stage(source, func, out_queue, stop):
+    #
+    # One stage of the pipeline in run_journal, run in its own thread. Put func(x) on out_queue for each x from source (or x
+    # itself when there is no func), then the end marker. An exception is passed on to the next stage instead. The stage ends
+    # early when stop is set.
+    #
     try:
-        #print(resp)
-        for citation in resp['citations']:
-            if citation['Genre'] == 'Article':
-                if (citation['Volume'] == vol) & (spage == citation['SPage']):
-                    #print('part url is: ',citation['PartUrl'])
-                    part_id = citation['PartUrl'].split('/')[-1]  # Separate part id from part URL
-    except:
-        pass  
-    return part_id  
+        for crnt in source:
+            if not put_stage(out_queue, (func(crnt) if func else crnt, None), stop):
+                return
+        put_stage(out_queue, (end_marker, None), stop)
+    except BaseException as err:
+        put_stage(out_queue, (end_marker, err), stop)
 
-#
-#  Main routine
-#            
+def from_stage(in_queue, stop):
+    #
+    # Yield the results put on in_queue by run_stage, in order, until the end marker or until stop is set. Raises the exception
+    # of an earlier stage.
+    #
+    while not stop.is_set():
+        try:
+            crnt, err = in_queue.get(timeout=stage_wait)
+        except queue.Empty:
+            continue
+        if err is not None:
+            raise err
+        if crnt is end_marker:
+            return
+        yield crnt
 
-issn, start_yr, end_yr, prefix, chk_existing = get_input()             # Prompt for input
-#print(issn, start_yr, end_yr, prefix, chk_existing)
-read_items_BHL()             # Get BHL item ids for all issues for the selected ISSN
-                             
-#print('BHL_items built: ',BHL_items)
+def start_stage(source, stop, func=None):
+    #
+    # Start a pipeline stage and return the queue its results are put on. The queue holds at most queue_pages pages, so a
+    # fast stage waits for a slow one instead of filling memory. Setting stop ends the stage.
+    #
+    out_queue = queue.Queue(queue_pages)
+    threading.Thread(target=run_stage, args=(source, func, out_queue, stop), daemon=True).start()
+    return out_queue
 
-output_file = open(prefix+'_'+start_yr+'_'+end_yr+'.tsv','w+', newline='', encoding='utf-8')  # Construct filename and open output tsv file
-writer = csv.writer(output_file, dialect='excel-tab')
-#
-# Write column headings to the tsv file
-#
-writer.writerow(('Title','Translated Title','Item ID','Volume','Issue','Series','Date','Language','Authors','Start Page','End Page','Start Page BHL ID','End Page BHL ID','Additional Page IDs','Article DOI','Part ID'))
+def wrt_checkpoint(cursor, rows, records):
+    #
+    # Save the harvest position after a page has been written. The tsv file is flushed first so the saved offset is on disk.
+    #
+    output_file.flush()
+    ckpt = {'cursor':cursor, 'rows':rows, 'records':records, 'offset':output_file.tell(), 'BHL_items':BHL_items.to_list(), 'BHL_item_ids':BHL_item_ids}
+    with bhl_files.replace_file(ckpt_name) as fh:
+        json.dump(ckpt, fh)
 
-works = Works()          # Get ready to use crossrefapi python library
+def run_journal(in_issn, in_start_yr, in_end_yr, in_prefix, in_chk_existing):
+    #
+    # Gather Crossref article metadata for one journal and date range and write it to a tsv file. Resumes from the checkpoint
+    # file if a previous run was interrupted. Returns the number of rows written. BHL lookups for the ISSN are kept in
+    # title_cache so that later runs for the same journal in this process do not repeat them. They are stored there only once
+    # they are complete, so a run that fails part way leaves nothing half built for the next run.
+    #
+    global issn, start_yr, end_yr, chk_existing, output_file, writer, ckpt_name, progress
+    global BHL_items, BHL_item_ids, BHL_parts, BHL_part_titles, BHL_match
+    issn, start_yr, end_yr, chk_existing = in_issn, in_start_yr, in_end_yr, in_chk_existing
+    output_name = in_prefix+'_'+start_yr+'_'+end_yr+'.tsv'       # Construct filename
+    ckpt_name = output_name+'.ckpt'
+    cached = issn in title_cache
+    if cached:
+        BHL_items, BHL_item_ids, BHL_parts, BHL_part_titles, BHL_match = title_cache[issn]
+    else:
+        BHL_items, BHL_item_ids, BHL_parts, BHL_part_titles, BHL_match = bhl_enum.ItemIndex(), [], {}, {}, bhl_match.PartIndex()
 
-# A few sample commands
-#myresults=works.filter(issn='0002-9122', from_pub_date='1922', until_pub_date='1923').sort('issued').select('title', 'DOI', 'volume','issue','page','author','published-print','type')
-#myresults=works.filter(issn=issn, until_pub_date=start_yr,from_pub_date=end_yr).count()
-#
-# Add input parms to the command. Perhaps not the best way to do this.
-#
-bldcmd = "myresults=works.filter(issn='"+issn+"', from_pub_date='"+start_yr+"', until_pub_date='"+end_yr+"').sort('issued').select('title', 'DOI', 'volume','issue','page','author','published-print','type')"
-exec(bldcmd)    # Now that input parms have been added, run the command
+    if os.path.exists(ckpt_name) and os.path.exists(output_name):   # Resume an interrupted run?
+        with open(ckpt_name, encoding='utf-8') as fh:
+            ckpt = json.load(fh)
+        if not cached:
+            BHL_items = bhl_enum.ItemIndex.from_list(ckpt['BHL_items'])
+            BHL_item_ids.extend(ckpt['BHL_item_ids'])
+        cursor, rows, records = ckpt['cursor'], ckpt['rows'], ckpt['records']
+        output_file = open(output_name,'r+', newline='', encoding='utf-8')
+        output_file.truncate(ckpt['offset'])        # Drop rows written after the last checkpoint
+        output_file.seek(ckpt['offset'])
+        writer = csv.writer(output_file, dialect='excel-tab')
+        print(output_name,'resuming after',rows,'rows')
+    else:
+        if not cached:
+            read_items_BHL()             # Get BHL item ids for all issues for the selected ISSN
+        #print('BHL_items built: ',BHL_items)
+        cursor, rows, records = '*', 0, 0
+        output_file = open(output_name,'w+', newline='', encoding='utf-8')  # Open output tsv file
+        writer = csv.writer(output_file, dialect='excel-tab')
+        #
+        # Write column headings to the tsv file
+        #
+        writer.writerow(('Title','Translated Title','Item ID','Volume','Issue','Series','Date','Language','Authors','Start Page','End Page','Start Page BHL ID','End Page BHL ID','Additional Page IDs','Article DOI','Part ID','Match Score'))
+        wrt_checkpoint(cursor, rows, records)
+
+    title_cache[issn] = (BHL_items, BHL_item_ids, BHL_parts, BHL_part_titles, BHL_match)   # Items complete
+    progress = bhl_stats.Progress('Crossref records')
+    progress.done = records
+    skip = 0
+    #
+    # The work is done in a pipeline: one thread reads Crossref pages, a second builds the output rows (item lookup and BHL article
+    # matching) and this thread writes them. Pages are passed on in order, so the tsv file and the checkpoints are the same as when
+    # the work is done one page after another, but the next Crossref page is read while the current one is matched and written.
+    # Reading Crossref starts before the existing BHL articles are read, so the first pages are ready when matching can begin.
+    # When the run ends, also on an error, stop is set so both pipeline threads end instead of waiting on a full queue.
+    #
+    def fetch_pages():
+        nonlocal skip, records
+        pages = crossref_pages(cursor)
+        try:
+            first = next(pages, None)
+        except urllib.error.HTTPError:   # Crossref cursors expire after a few minutes without use. Start again and skip the records already written.
+            if cursor == '*':
+                raise
+            print('Saved Crossref cursor has expired. Skipping',records,'records already processed.')
+            skip, records = records, 0
+            progress.done = 0
+            pages = crossref_pages('*')
+            first = next(pages, None)
+        if first:
+            yield first
+            yield from pages
+
+    def match_page(crnt):
+        nonlocal records
+        crnt_page, crnt_cursor = crnt
+        page_rows = []
+        for crnt_item in crnt_page:        # Process each citation returned by Crossref
+            records += 1
+            if records <= skip:
+                continue
+            if crnt_item['type'] == 'journal-article':
+                page_rows.append(art_row(crnt_item))
+        if chk_existing == 'y' or chk_existing == 'Y':   # Did user choose to match Crossref articles to existing BHL articles?
+            matches = defined_BHL([(row[0], row[9], row[3], row[6][:4]) for row in page_rows])   # Title, start page, volume and year
+        else:
+            matches = [('', '')] * len(page_rows)
+        page_rows = [row + match for row, match in zip(page_rows, matches)]
+        return page_rows, crnt_cursor, records, len(crnt_page)
+
+    stop = threading.Event()
+    try:
+        fetched = start_stage(fetch_pages(), stop)
+        if (chk_existing == 'y' or chk_existing == 'Y') and issn not in parts_read:
+            BHL_parts, BHL_part_titles, BHL_match = {}, {}, bhl_match.PartIndex()   # Drop articles left by an earlier failed read
+            read_parts_BHL()         # Get existing BHL articles for all items
+            title_cache[issn] = (BHL_items, BHL_item_ids, BHL_parts, BHL_part_titles, BHL_match)
+            parts_read.add(issn)
+        matched = start_stage(from_stage(fetched, stop), stop, match_page)
+        for page_rows, crnt_cursor, crnt_records, count in from_stage(matched, stop):
+            writer.writerows(page_rows)    # Write article metadata for the page to the output file
+            rows += len(page_rows)
+            wrt_checkpoint(crnt_cursor, rows, crnt_records)
+            progress.step(count)
+    finally:
+        stop.set()
+    progress.close()
 
-for crnt_item in myresults:    # Process each citation returned by Crossref
-    if crnt_item['type'] == 'journal-article':
-        wrt_art(crnt_item)     # Write article metadata for the current citation to the output file
-output_file.close()            # Close the output file
+    output_file.close()            # Close the output file
+    os.remove(ckpt_name)           # Run complete. Checkpoint no longer needed.
+    return rows
 
+#
+#  Main routine
+#            
+if __name__ == '__main__':
+    run_journal(*get_input())      # Prompt for input, then gather the article metadata
+    bhl_cache.report()
@@ -0,0 +1,113 @@
+#
+# This program runs cr2bhl.py for many journals without prompting. The journals are listed in a manifest file, either a csv file
+# with a heading row or a json file holding a list of objects. Both use the fields
+#
+#   issn, start_yr, end_yr, prefix, chk_existing
+#
+# with the same meaning and format as the cr2bhl.py prompts, e.g.
+#
+#   issn,start_yr,end_yr,prefix,chk_existing
+#   0002-9122,1922,1923,ajb,n
+#
+# Journals are processed in parallel by a pool of worker processes. Each journal writes its own tsv file, named as in cr2bhl.py,
+# and can be resumed from its checkpoint file like a single cr2bhl.py run. All rows for the same ISSN are run by the same worker
+# one after another so the BHL title, item and part lookups for that ISSN are built once. A status and timing line for each row of
+# the manifest is printed at the end and written to batch_report.tsv. The request counts of all workers are added together and
+# written to bhl_stats.json (see bhl_stats.py) as for a single cr2bhl.py run.
+#
+#  Sample call
+#    python cr2bhl_batch.py journals.csv 4
+#
+#  Import needed libraries
+#
+import re
+import sys
+import csv
+import json
+import time
+from concurrent.futures import ProcessPoolExecutor
+import cr2bhl
+import bhl_stats
+
+max_workers = 4      # Default number of worker processes. May be overridden by the second command line argument.
+fields = ('issn','start_yr','end_yr','prefix','chk_existing')
+
+def read_manifest(manifest):
+    #
+    #  Read the list of journals from a csv or json manifest file
+    #
+    with open(manifest, newline='', encoding='utf-8') as fh:
+        if manifest.lower().endswith('.json'):
+            jobs = json.load(fh)
+        else:
+            jobs = list(csv.DictReader(fh))
+    return [tuple(str(job.get(field,'')).strip() for field in fields) for job in jobs]
+
+def chk_job(job):
+    #
+    #  Check one manifest row. Returns an error message, or the empty string when the row is valid.
+    #
+    issn, start_yr, end_yr, prefix, chk_existing = job
+    if None == re.fullmatch(r'^[0-9]{4}-[0-9]{3}[0-9xX]$',issn):
+        return 'ISSN must be in xxxx-xxxx format'
+    if None == re.fullmatch(r'\d{4}',start_yr) or None == re.fullmatch(r'\d{4}',end_yr):
+        return 'Starting and ending year must be in YYYY format'
+    if None == re.fullmatch(r'\w+',prefix):
+        return 'Prefix must be a short word'
+    if None == re.fullmatch(r'[yYnN]',chk_existing):
+        return 'Check existing must be y or n'
+    return ''
+
+def run_jobs(jobs):
+    #
+    #  Run the manifest rows for one ISSN in a worker process. Returns (row number, status, seconds, rows written) for each row
+    #  and the request counts of the worker, which are not written when a worker process ends.
+    #
+    results = []
+    for rownum, job in jobs:
+        start = time.monotonic()
+        try:
+            rows = cr2bhl.run_journal(*job)
+            status = 'ok'
+        except (Exception, SystemExit) as err:    # cr2bhl calls exit() on some errors. Record the failure and go on with the next journal.
+            rows = 0
+            status = 'failed: ' + (str(err) or type(err).__name__)
+        results.append((rownum, status, time.monotonic() - start, rows))
+    return results, bhl_stats.take()
+
+#
+#  Main routine
+#
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print('Usage: python cr2bhl_batch.py <manifest csv or json> [number of workers]')
+        exit()
+    jobs = read_manifest(sys.argv[1])
+    if len(sys.argv) > 2:
+        max_workers = int(sys.argv[2])
+
+    report = {}
+    groups = {}          # Manifest rows grouped by ISSN
+    for rownum, job in enumerate(jobs, 1):
+        error = chk_job(job)
+        if error:
+            report[rownum] = ('skipped: ' + error, 0.0, 0)
+        else:
+            groups.setdefault(job[0].upper(), []).append((rownum, job))
+
+    start = time.monotonic()
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        for results, ops in pool.map(run_jobs, groups.values()):
+            bhl_stats.merge(ops)
+            for rownum, status, seconds, rows in results:
+                report[rownum] = (status, seconds, rows)
+    elapsed = time.monotonic() - start
+
+    with open('batch_report.tsv','w', newline='', encoding='utf-8') as fh:
+        writer = csv.writer(fh, dialect='excel-tab')
+        writer.writerow(fields + ('status','seconds','rows'))
+        for rownum, job in enumerate(jobs, 1):
+            status, seconds, rows = report[rownum]
+            writer.writerow(job + (status, f'{seconds:.1f}', rows))
+            print(f'{job[3]}_{job[1]}_{job[2]}: {status}, {rows} rows, {seconds:.1f} s')
+    print(f'{len(jobs)} journals in {elapsed:.1f} s')
@@ -0,0 +1,59 @@
+#
+# Tests of the enumeration parser and item index in bhl_enum.py. Run with: python -m pytest tests
+#
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import bhl_enum
+
+class ParseEnumTest(unittest.TestCase):
+    def test_volume_and_year(self):
+        self.assertEqual(bhl_enum.parse_enum(1, 'v.12 (1905)'), bhl_enum.Enumeration(1, '', 12, 12, None, None, 1905, 1905))
+
+    def test_ranges(self):
+        self.assertEqual(bhl_enum.parse_enum(2, 'v.1-2=no.1-8 (1950-1951)'), bhl_enum.Enumeration(2, '', 1, 2, 1, 8, 1950, 1951))
+        self.assertEqual(bhl_enum.parse_enum(3, 'v.4 (1950/51)').year_end, 1951)
+
+    def test_series_and_issue(self):
+        self.assertEqual(bhl_enum.parse_enum(4, 'ser.2:v.3 (1890)').series, '2')
+        self.assertEqual(bhl_enum.parse_enum(5, 'n.s. v.3').series, 'ns')
+        record = bhl_enum.parse_enum(6, 'v.5:no.3 (1920)')
+        self.assertEqual((record.issue_start, record.issue_end), (3, 3))
+
+    def test_item_year(self):
+        self.assertEqual(bhl_enum.parse_enum(7, 'v.9', '1931').year_start, 1931)
+
+    def test_no_volume(self):
+        self.assertIsNone(bhl_enum.parse_enum(8, 'Index (1900-1950)'))
+
+class LookupTest(unittest.TestCase):
+    def setUp(self):
+        self.index = bhl_enum.ItemIndex()
+        self.index.add(7, 'Index v.1-50 (1900-1950)')
+        self.index.add(4, 'v.5:no.4 (1920)')
+        self.index.add(6, 'v.12')
+        self.index.add(5, 'v.5:no.1-3 (1920)')
+        self.index.add(9, 'ser.2:v.5 (1960)')
+
+    def test_most_specific_first(self):
+        self.assertEqual(self.index.lookup(5, 4), [4, 9, 7])
+        self.assertEqual(self.index.lookup(12), [6, 7])
+        self.assertEqual(self.index.lookup(5, 2, 1920, series=''), [5, 7])
+
+    def test_issue_and_year(self):
+        self.assertEqual(self.index.lookup(5, 4, 1920, series=''), [4, 7])
+        self.assertEqual(self.index.lookup(5, 9, 1920, series=''), [7])
+        self.assertEqual(self.index.lookup(5, None, 1960), [9])
+
+    def test_missing(self):
+        self.assertEqual(self.index.lookup(60), [])
+        self.assertEqual(self.index.lookup(''), [])
+
+    def test_to_list(self):
+        index = bhl_enum.ItemIndex.from_list(self.index.to_list())
+        self.assertEqual(index.lookup(5, 4), self.index.lookup(5, 4))
+
+if __name__ == '__main__':
+    unittest.main()
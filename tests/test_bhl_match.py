@@ -0,0 +1,50 @@
+#
+# Tests of the fuzzy part matching in bhl_match.py. Run with: python -m pytest tests
+#
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import bhl_match
+
+match_score = 0.8      # Score cr2bhl.py requires of an inexact match
+
+class PartIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.index = bhl_match.PartIndex()
+        self.index.add('1', 'On some butterflies of Japan', '7', '113', '1921')
+        self.index.add('2', 'Book reviews', '7', '140', '1921')
+        self.index.add('3', 'Book reviews', '8', '95', '1922')
+        self.index.add('4', '', '8', '120', '1922')
+
+    def test_exact(self):
+        self.assertEqual(self.index.match('On some butterflies of Japan', '7', '113', '1921'), ('1', 1.0))
+
+    def test_similar_title(self):
+        part_id, score = self.index.match('On some Butterflies of Japan.', '7', '114', '1921')
+        self.assertEqual(part_id, '1')
+        self.assertGreaterEqual(score, match_score)
+        part_id, score = self.index.match('On some butterflies of Japan', '7', '', '')   # No page or year
+        self.assertEqual(part_id, '1')
+        self.assertGreaterEqual(score, match_score)
+
+    def test_title_only(self):
+        part_id, score = self.index.match('Book reviews', '', '', '')
+        self.assertLess(score, match_score)
+
+    def test_recurring_title(self):
+        self.assertEqual(self.index.match('Book reviews', '8', '95', '1922')[0], '3')
+        self.assertEqual(self.index.match('Book reviews', '7', '20', '1921'), ('', 0.0))   # Start pages too far apart
+
+    def test_untitled(self):
+        self.assertEqual(self.index.match('', '8', '120', '1922'), ('', 0.0))
+        self.assertEqual(self.index.match('Notes', '8', '120', '1922'), ('', 0.0))
+
+    def test_match_all(self):
+        articles = [('Book reviews', '8', '95', '1922'), ('On some butterflies of Japan', '7', '113', '1921'),
+                    ('Book reviews', '8', '95', '1922'), ('', '', '', '')]
+        self.assertEqual(self.index.match_all(articles), [self.index.match(*article) for article in articles])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+#
+# Tests of the streaming json reader in bhl_stream.py. Run with: python -m pytest tests
+#
+import io
+import os
+import sys
+import json
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import bhl_stream
+import bhl_client
+
+class Dropped(io.BytesIO):
+    #
+    # Stream that loses its connection after limit bytes
+    #
+    def __init__(self, data, limit):
+        super().__init__(data)
+        self.limit = limit
+
+    def read(self, size=-1):
+        if self.tell() >= self.limit:
+            raise ConnectionResetError('connection reset')
+        return super().read(min(size, self.limit - self.tell()) if size > 0 else self.limit - self.tell())
+
+def response(records, key='Pages', status='ok'):
+    return json.dumps({'Status': status, 'ErrorMessage': '', 'Result': [{'ItemID': 5, key: records, 'Other': [1, 2]}]},
+                      ensure_ascii=False, indent=1).encode('utf-8')
+
+class RecordsTest(unittest.TestCase):
+    def setUp(self):
+        self.chunk_size = bhl_stream.chunk_size
+        bhl_stream.chunk_size = 7          # Small chunks so records, strings and numbers are split between reads
+
+    def tearDown(self):
+        bhl_stream.chunk_size = self.chunk_size
+
+    def test_records(self):
+        records = [{'PageID': 10**12 + num, 'Text': 'é✓ "q" \\ x' * (num % 3), 'Values': [1.5, None, True, -3]} for num in range(200)]
+        reader = bhl_stream.Records(io.BytesIO(response(records)), ('Result', 0, 'Pages'))
+        self.assertTrue(reader.found)
+        self.assertEqual(reader.fields['Status'], 'ok')
+        self.assertEqual(list(reader), records)
+
+    def test_empty_and_missing(self):
+        self.assertEqual(list(bhl_stream.Records(io.BytesIO(response([])), ('Result', 0, 'Pages'))), [])
+        reader = bhl_stream.Records(io.BytesIO(response([{'a': 1}])), ('Result', 0, 'Parts'))
+        self.assertFalse(reader.found)
+        self.assertEqual(list(reader), [])
+
+    def test_error_response(self):
+        reader = bhl_stream.Records(io.BytesIO(b'{"Status":"error","ErrorMessage":"x","Result":null}'), ('Result', 0, 'Items'))
+        self.assertEqual(reader.fields['Status'], 'error')
+        self.assertEqual(list(reader), [])
+
+    def test_truncated(self):
+        data = response([{'PageID': num} for num in range(20)])
+        with self.assertRaises(json.JSONDecodeError):
+            list(bhl_stream.Records(io.BytesIO(data[:len(data) // 2]), ('Result', 0, 'Pages')))
+
+    def test_retry(self):
+        records = [{'PageID': num} for num in range(50)]
+        data = response(records)
+        streams = [Dropped(data, 300), Dropped(data, 900), io.BytesIO(data)]
+        open_url, retry_wait = bhl_stream.bhl_cache.open_url, bhl_client.retry_wait
+        bhl_stream.bhl_cache.open_url = lambda url, refresh=False: streams.pop(0)
+        bhl_client.retry_wait = lambda attempt, retry_after: 0
+        try:
+            reader = bhl_stream.open_records('http://localhost/api3?op=GetItemMetadata', ('Result', 0, 'Pages'))
+            self.assertEqual(list(reader), records)
+            self.assertEqual(reader.attempt, 2)
+        finally:
+            bhl_stream.bhl_cache.open_url, bhl_client.retry_wait = open_url, retry_wait
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+#
+# Tests of the page pipeline in cr2bhl.py. Run with: python -m pytest tests
+#
+import os
+import sys
+import time
+import itertools
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import cr2bhl
+
+class PipelineTest(unittest.TestCase):
+    def setUp(self):
+        self.stage_wait = cr2bhl.stage_wait
+        cr2bhl.stage_wait = 0.05
+
+    def tearDown(self):
+        cr2bhl.stage_wait = self.stage_wait
+
+    def wait_for_threads(self, count):
+        end = time.monotonic() + 5
+        while threading.active_count() > count and time.monotonic() < end:
+            time.sleep(0.01)
+        return threading.active_count()
+
+    def test_in_order(self):
+        stop = threading.Event()
+        fetched = cr2bhl.start_stage(range(20), stop)
+        matched = cr2bhl.start_stage(cr2bhl.from_stage(fetched, stop), stop, lambda crnt: crnt * 2)
+        self.assertEqual(list(cr2bhl.from_stage(matched, stop)), [crnt * 2 for crnt in range(20)])
+
+    def test_error_passed_on(self):
+        def fail(crnt):
+            if crnt == 3:
+                raise ValueError('bad page')
+            return crnt
+        stop = threading.Event()
+        fetched = cr2bhl.start_stage(range(10), stop, fail)
+        matched = cr2bhl.start_stage(cr2bhl.from_stage(fetched, stop), stop)
+        with self.assertRaises(ValueError):
+            list(cr2bhl.from_stage(matched, stop))
+
+    def test_stop(self):
+        count = threading.active_count()
+        stop = threading.Event()
+        fetched = cr2bhl.start_stage(itertools.count(), stop)       # Never ends: the stages wait on full queues
+        matched = cr2bhl.start_stage(cr2bhl.from_stage(fetched, stop), stop, lambda crnt: crnt)
+        self.assertEqual(next(cr2bhl.from_stage(matched, stop)), 0)
+        time.sleep(0.1)
+        self.assertEqual(threading.active_count(), count + 2)
+        stop.set()
+        self.assertEqual(self.wait_for_threads(count), count)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,25 @@
+#
+# Tests of directory mode in toc_plmd.py. Run with: python -m pytest tests
+#
+import os
+import sys
+import itertools
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import toc_plmd
+
+class TocFilesTest(unittest.TestCase):
+    def test_files_of_an_item_together(self):
+        with tempfile.TemporaryDirectory() as dirname:
+            for fname in ('10373.txt', '10373_p2.txt', '103730.txt', '9.txt', 'notes.txt', '10373.pdf'):
+                open(os.path.join(dirname, fname), 'w').close()
+            files = toc_plmd.toc_files(dirname)
+            self.assertEqual([(crnt_item, os.path.basename(fname)) for crnt_item, fname in files],
+                             [(9, '9.txt'), (10373, '10373.txt'), (10373, '10373_p2.txt'), (103730, '103730.txt')])
+            self.assertEqual([crnt_item for crnt_item, group in itertools.groupby(files, lambda crnt: crnt[0])], [9, 10373, 103730])
+            self.assertEqual(os.path.dirname(files[0][1]), dirname)
+
+if __name__ == '__main__':
+    unittest.main()
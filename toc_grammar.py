@@ -0,0 +1,108 @@
+#
+# Table of contents parsing for toc_plmd.py.
+#
+#  The layout of an OCRed table of contents differs from journal to journal, so the rules that find authors, titles and start pages
+#  are kept in a grammar, one per layout. The regular expressions of each grammar are compiled once when the module is loaded. A
+#  grammar is selected by name, or by BHL title id through the journals dictionary. To support another layout, create a Grammar
+#  with its own patterns (or a subclass with its own parse method), add it with register() and list its title ids in journals.
+#
+#  Files of OCR text can be parsed in parallel by a pool of worker processes with parse_files(). Records are returned file by file
+#  in the order of the file names, as soon as each file is parsed.
+#
+#  Sample use
+#    for article in toc_grammar.get_grammar('papilio').parse(lines):
+#        ...
+#    for fname, articles in toc_grammar.parse_files(fnames, 'papilio'):
+#        ...
+#
+#  Load needed libraries
+#
+import re
+from concurrent.futures import ProcessPoolExecutor
+
+default_grammar = 'papilio'     # Grammar used when none is named and the title id is not in journals
+journals = {}                   # Grammar name by BHL title id, e.g. {'123456': 'papilio'}
+grammars = {}                   # Registered grammars. Key is the grammar name.
+
+class Grammar:
+    #
+    # Layout in which an author line is followed by the titles of that author's articles, each ending with the start page.
+    # A title may run over several lines. author is the pattern of an author line, page the pattern of the start page at the
+    # end of a title line and skip the pattern of author-like lines that are not authors.
+    #
+    def __init__(self, name, author, page, skip=None):
+        self.name = name
+        self.author = re.compile(author)
+        self.page = re.compile(page)
+        self.skip = re.compile(skip, re.IGNORECASE) if skip else None
+
+    def fmt_author(self, author):
+        #
+        # Format an author name as written in the output file
+        #
+        return author
+
+    def parse(self, lines):
+        #
+        # Parse the lines of an OCRed table of contents. Yields a dictionary with author, title and starting page number for each article.
+        #
+        crnt_title = []         # Lines of a title that runs over several lines
+        crnt_auth = ''
+        for line in lines:      # Process every line in the table of contents.
+            if line.isspace():  # Ignore blank lines
+                continue
+            if self.author.search(line):   # Author name found?
+                crnt_auth = line.strip()
+                crnt_auth = '' if self.skip and self.skip.match(crnt_auth) else self.fmt_author(crnt_auth)
+                continue
+            match = self.page.search(line)
+            if match:            # Title, author and start page for an article found
+                crnt_title.append(line[:match.start(1)])
+                yield {'title':''.join(crnt_title), 'author':crnt_auth, 'spage':match.group(1)}
+                crnt_title = []
+            else:                # Found a partial title
+                crnt_title.append(line.strip()+' ')
+
+class Papilio(Grammar):
+    #
+    # Early issues of Papilio, e.g. https://www.biodiversitylibrary.org/pagetext/10373385
+    #   <surname>,<first name or initials>.
+    #   <title 1> <starting page number 1>
+    #   <title 2> <starting page number 2>
+    # All author names end with a period and nothing follows the period on the line. The page number ends the title line.
+    #
+    def __init__(self):
+        super().__init__('papilio', r'\.\s*$', r'(\d+)\s*$', skip=r'page')   # Don't mistake the word page for an author name
+
+    def fmt_author(self, author):
+        end_surnm = author.find(',')
+        author = author[0].upper()+author[1:end_surnm].lower()+author[end_surnm:]
+        if author[-1] == '.' and author[-3] != ' ':  # Remove a period that follows a given name. Retain a period that follows an initial.
+            author = author.rstrip('.')
+        return author
+
+def register(grammar):
+    grammars[grammar.name] = grammar
+
+register(Papilio())
+
+def get_grammar(name=None, titleid=None):
+    #
+    # Return the grammar with this name, or the one listed for the title id in journals, or the default grammar
+    #
+    return grammars[name or journals.get(str(titleid), default_grammar)]
+
+def parse_file(args):
+    #
+    # Parse one OCR text file. Runs in a worker process. Returns the file name and the list of articles.
+    #
+    fname, name = args
+    with open(fname, encoding='utf-8', errors='replace') as fh:
+        return fname, list(grammars[name].parse(fh))
+
+def parse_files(fnames, name=default_grammar, max_workers=None):
+    #
+    # Parse many OCR text files with a pool of worker processes. Yields (file name, articles) in the order of fnames.
+    #
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        yield from pool.map(parse_file, [(fname, name) for fname in fnames], chunksize=16)
@@ -10,97 +10,166 @@
 #    - issue
 #    - year
 #    - BHL starting page id
-#  Initially, the code made an educated guessed the ending page and page id. The results were poor and the code was removed.
-#  Successful parsing of the table of contents is dependent on the exact format of the table of contents. This code was written for the early issues of Papilio.
+#  The ending page and page id are inferred from the start page of the next article in the table of contents: the article ends on
+#  the last numbered page before it, in the page sequence of the item. The ending page of the last article is left empty.
+#  Page level metadata is kept in a compact page index (bhl_pages.py). In title mode the index is saved to BHL_pages_<title id>.json
+#  and reused by the next run for the same title, for up to index_days days.
+#  Successful parsing of the table of contents is dependent on the exact format of the table of contents. The layout rules are kept
+#  in grammars in toc_grammar.py, chosen by title id or by grammar_name below. The first grammar was written for the early issues of Papilio.
 #  For example, see https://www.biodiversitylibrary.org/pagetext/10373385. General format of the table of contents in this publication is:
 #   <surname>,<first name or initials>.
 #   <title 1> <starting page number 1>
 #   <title 2> <starting page number 2>
+#  To process a whole title, enter t followed by the BHL title id (e.g. t123456) instead of an item id. Page level metadata for all
+#  items of the title is read by a pool of worker threads (see max_workers). For each item, the OCR text of the pages marked as
+#  Table of Contents in BHL is read through the BHL API and parsed as above. All articles are written to one tsv file. When a single
+#  item id is entered, the table of contents is read from the file TOC_OCR.txt as before. Enter d followed by a directory name
+#  to parse every OCR text file in the directory; each file name starts with the item id (e.g. 10373.txt or 10373_p2.txt). The
+#  files are parsed by a pool of worker processes.
+#  The BHL address may be changed with the BHL_URL environment variable, e.g. to run against the local stub server in benchmarks/.
 #
 #  Import needed libraries
 #
 import re
+import os
 import csv
 import urllib.parse
-import urllib.request
 import json
+import time
+import bisect
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+import bhl_cache
+import bhl_stream
+import bhl_stats
+import bhl_pages
+import toc_grammar
 from config import BHL_key
 
-BHL_pages = {}       # Build dictionary. Key is the page number.  Other fields include item id, volume, issue,
-                              # year and page id. All fields of these fields come from the BHL page level metadata.
-
-art_list = []   # List of metadata fields derived from the TOC. This includes author, title and starting page number.
+BHL_pages = bhl_pages.PageIndex()   # BHL page level metadata: item id, volume, issue, year and page id of every page, looked up
+                                    # by item id, prefix and page number (see bhl_pages.py)
+service_url = os.environ.get('BHL_URL','https://www.biodiversitylibrary.org/') + 'api3?'
+max_workers = 8      # Maximum number of concurrent requests sent to BHL in title and directory mode
+index_file = 'BHL_pages_%s.json'   # Page index saved in title mode (%s is the title id) and reused by the next run. Empty: not saved.
+index_days = 7       # A saved page index older than this is read again from BHL
+grammar_name = None  # Table of contents layout (see toc_grammar.py). None: chosen by title id, otherwise Papilio.
 
 def get_input ():
     #
-    #  Prompt user for the BHL item id
+    #  Prompt user for the BHL item id, t followed by the BHL title id, or d followed by a directory of OCR files
     #
-    itemid = input('Enter BHL item id: ')
-    if None == re.fullmatch(r'\d+',itemid):
-        print('You must enter the item id in nnnnnn format')
+    itemid = input('Enter BHL item id, t and a title id to process a whole title (e.g. t123456), or d and a directory of TOC files (e.g. dtocs): ')
+    if itemid.startswith('d') and os.path.isdir(itemid[1:]):
+        return (itemid)
+    if None == re.fullmatch(r't?\d+',itemid):
+        print('You must enter the item id in nnnnnn format, the title id in tnnnnnn format or d followed by a directory name')
         exit()
     return (itemid)
 
-def read_pages_BHL(itemid):
+def read_items_BHL(titleid):
+    #
+    # Return the item ids of all items of the title
     #
-    # Gather BHL page level metadata for this item and build a dictionary called BHL_pages. Dictionary key is the page number.
+    url=service_url + urllib.parse.urlencode({'op':'GetTitleMetadata','format':'json','id':titleid,'items':'t','apikey':BHL_key})
+    #print(url)
+    items = bhl_stream.open_records(url, ('Result', 0, 'Items'))   # Read the items one at a time
+    if items.fields.get('Status') != 'ok' or not items.found:
+        print('Unable to read BHL items for title.')
+        exit()
+    return [item['ItemID'] for item in items]
+
+def get_pages_BHL(itemid):
     #
-    service_url = 'https://www.biodiversitylibrary.org/api3?'
-    
+    # Call the BHL API for the page level metadata of one item. Returns the pages, read one at a time as the response arrives,
+    # or None if the call fails.
     #
-    # Prepare the search command and then call the BHL API
     url=service_url + urllib.parse.urlencode({'op':'GetItemMetadata','format':'json','id':itemid,'pages':'t','apikey':BHL_key})
     #print(url)
-    uh=urllib.request.urlopen(url)
-    mydata=uh.read().decode('utf-8')
-    resp=json.loads(mydata)
-    #print(resp)
-    if 'Status' not in resp or resp['Status'] != 'ok':
-        print('Unable to read BHL page level metadata for item.')
-        exit()
+    pages = bhl_stream.open_records(url, ('Result', 0, 'Pages'))
+    if pages.fields.get('Status') != 'ok':
+        pages.close()
+        return None
+    return pages
 
-    for page in resp['Result'][0]['Pages']:   # Process each BHL page returned. Collect page level metadata for each page.
-        pageid = page['PageID'] 
-        itemid = page['ItemID']
-        vol = page['Volume']
-        issue = page['Issue']
-        year = page['Year']
-        number = ''
-        for pagenum in page['PageNumbers']:
-            if pagenum['Prefix'] == 'Page':
-               number = pagenum['Number']
-            if number:
-                BHL_pages[number] = {'itemid' : itemid,  'year': year, 'vol': vol, 'issue': issue, 'pageid': pageid}
-               
-    
-def wrt_md():
+def load_pages(itemid):
     #
-    #  Write metadata to the output file. The output file is a tsv file in the format expected by the BHL Create Segments function.
+    # Read the page level metadata of one item into BHL_pages. Returns False if the call fails. Runs in a worker thread in title mode.
     #
+    pages = get_pages_BHL(itemid)
+    if pages is None:
+        return False
+    read_pages_BHL(pages)
+    return True
 
-    aitemid = avolume = aissue = aauthors = atitle = adate = aspage = aepage = aspageid = aepageid = ''  # Initialize metadata variables to the empty string
-    for article in art_list:  # Process each article. art_list is derived from the OCRed table of contents.
-        aspage = article['spage']
-        try:
-            aitemid=BHL_pages[aspage]['itemid']   # Use dictionary built from BHL page level metadata to obtain BHL item id. 
-        except:
-            pass
+def read_pages_BHL(pages):
+    #
+    # Add the page level metadata of one item to the BHL_pages index. Pages are looked up by item id, prefix and page number.
+    # Pages marked as Table of Contents are flagged in the index.
+    #
+    BHL_pages.add_item(pages)
 
-        try:
-            avolume= BHL_pages[aspage]['vol']   # Use dictionary built from BHL page level metadata to obtain volume. 
-        except:
-            pass
+def read_toc_BHL(pageid):
+    #
+    # Return the BHL OCR text of one page. Runs in a worker thread in title mode.
+    #
+    url=service_url + urllib.parse.urlencode({'op':'GetPageMetadata','format':'json','pageid':pageid,'ocr':'t','apikey':BHL_key})
+    #print(url)
+    mydata=bhl_cache.get_url(url)
+    resp=json.loads(mydata)
+    if 'Status' not in resp or resp['Status'] != 'ok' or len(resp['Result']) == 0:
+        print('Unable to read OCR text for page',pageid)
+        return ''
+    return resp['Result'][0].get('OcrText') or ''
 
-        try:
-            aissue = BHL_pages[aspage]['issue']  # Use dictionary built from BHL page level metadata to obtain issue. 
-        except:
-            pass
-            
+def art_pages(art_list, itemid):
+    #
+    # Find the first and last page of each article in the BHL_pages index. The first page is the page with the article's start page
+    # number; when several pages of the item have that number, the first one after the start of the previous article. The last page
+    # is the last numbered page before the first page of the next article. Returns a list of (first row, last row) in the order of
+    # art_list, with None for a page that is not found. The last page of the last article is not known.
+    #
+    starts = []
+    prev = -1
+    for article in art_list:
+        rows = BHL_pages.find(itemid, article['spage'])
+        row = next((row for row in rows if row >= prev), rows[0] if rows else None)
+        if row is not None:
+            prev = row
+        starts.append(row)
+    ordered = sorted(set(row for row in starts if row is not None))
+    pages = []
+    for row in starts:
+        last = None
+        if row is not None:
+            pos = bisect.bisect_right(ordered, row)
+            if pos < len(ordered):                                  # First page of the next article
+                last = BHL_pages.last_numbered(row, ordered[pos])
+        pages.append((row, last))
+    return pages
+
+def toc_files(dirname):
+    #
+    # Return (item id, file name) for each OCR text file in a directory. The file name starts with the item id. Files are sorted by item
+    # id and then by name, so the files of an item are next to each other.
+    #
+    files = [(int(re.match(r'\d+', fname).group()), fname) for fname in os.listdir(dirname) if re.match(r'\d+.*\.txt$', fname)]
+    return [(crnt_item, os.path.join(dirname, fname)) for crnt_item, fname in sorted(files)]
+
+def wrt_md(art_list, itemid):
+    #
+    #  Write metadata to the output file. The output file is a tsv file in the format expected by the BHL Create Segments function.
+    #
+    for article, (first, last) in zip(art_list, art_pages(art_list, itemid)):  # Process each article. art_list is derived from the OCRed table of contents.
+        aitemid = avolume = aissue = aauthors = atitle = adate = aspage = aepage = aspageid = aepageid = ''  # Initialize metadata variables to the empty string
+        aspage = article['spage']
+        if first is not None:    # Use the index built from BHL page level metadata to obtain item id, volume, issue, year and page id.
+            page = BHL_pages.page(first)
+            aitemid, avolume, aissue, adate, aspageid = page.itemid, page.vol, page.issue, page.year, page.pageid
+        if last is not None:
+            page = BHL_pages.page(last)
+            aepage, aepageid = page.number, page.pageid
         atitle = article['title'].replace('\n',' ')   # Replace carriage return with space if present.
-        adate = BHL_pages[aspage]['year']  # Use dictionary built from BHL page level metadata to obtain year.. 
-    
         aauthors = article['author']  # Author was obtained from the OCRed table of contents.
-        aspageid = BHL_pages[aspage]['pageid']  # Use dictionary built from BHL page level metadata to obtain BHL starting page id.
 
         writer.writerow((atitle,'',aitemid,avolume,aissue,'',adate,'',aauthors,aspage,aepage,aspageid,aepageid,'',''))              # Write a row to the tsv file
   
@@ -108,43 +177,69 @@ def wrt_md():
 #  Main routine
 #            
 
-itemid = get_input()                                        # Prompt for input
-read_pages_BHL(itemid)                                 # Get all BHL page level metadata for the item id. Save in BHL_pages.
-
-#print(BHL_pages)
-output_file = open('BHL_art_md.tsv','w+', newline='', encoding='utf-8')
-writer = csv.writer(output_file, dialect='excel-tab')
-#
-# Write column headings to the tsv file
-#
-writer.writerow(('Title','Translated Title','Item ID','Volume','Issue','Series','Date','Language','Authors','Start Page','End Page','Start Page BHL ID','End Page BHL ID','Additional Page IDs','Article DOI'))
-crnt_title = crnt_page = crnt_auth = ''
-fhand = open('TOC_OCR.txt')   # Open the file that contains the BHL OCR text for the table of contents.
+if __name__ == '__main__':                                  # Worker processes in directory mode import this file without running it
+    itemid = get_input()                                    # Prompt for input
 
-for line in fhand:       # Process every line in the table of contents.
-    if line.isspace():   # Empty line? 
-        continue          # Ignore blank lines
-    if line.rstrip().endswith('.'):  # Author name found?  In this table of contents, all author names end with a period. Nothing follows the period on the line.
-        crnt_auth = line.strip()
-        if crnt_auth.lower().find('page') == 0:   # Don't mistake the word page for an author name
-            crnt_auth = ''
-        else:
-            end_surnm = crnt_auth.find(',')
-            crnt_auth = crnt_auth[0].upper()+crnt_auth[1:end_surnm].lower()+crnt_auth[end_surnm:] 
-            if crnt_auth[-1] == '.' and crnt_auth[-3] != ' ':  # Remove a period that follows a given name. Retain a period that follows an initial.
-                crnt_auth = crnt_auth.rstrip('.')
-        continue
-    match = re.search(r'(\d+)\s*$',line) # Page number appears at the end of a line. Title precedes page number.
-    if match:
-        crnt_page = match.group(1)
-        crnt_title = crnt_title+line[:match.start(1)]
-        art_list.append({'title':crnt_title,'author':crnt_auth,'spage':crnt_page})  # Title, author and start page for an article found. Save values.
-        crnt_title = '' 
-    else:                                      # Found a partial title
-        crnt_title = crnt_title+line.strip()+' '
-
-#print(art_list)
-wrt_md()   # Write all article metadata to a tsv file. The file is formatted as expected by the BHL Create Segments function.
-output_file.close() 
+    output_file = open('BHL_art_md.tsv','w+', newline='', encoding='utf-8')
+    writer = csv.writer(output_file, dialect='excel-tab')
+    #
+    # Write column headings to the tsv file
+    #
+    writer.writerow(('Title','Translated Title','Item ID','Volume','Issue','Series','Date','Language','Authors','Start Page','End Page','Start Page BHL ID','End Page BHL ID','Additional Page IDs','Article DOI'))
 
+    if itemid.startswith('t'):                              # Whole title?
+        grammar = toc_grammar.get_grammar(grammar_name, itemid[1:])
+        itemids = read_items_BHL(itemid[1:])
+        fname = index_file % itemid[1:] if index_file else ''
+        if fname and os.path.exists(fname) and time.time() - os.path.getmtime(fname) < index_days * 86400:
+            BHL_pages = bhl_pages.PageIndex.load(fname)      # Page index saved by the last run
+        todo = [crnt_item for crnt_item in itemids if crnt_item not in BHL_pages.items]
+        progress = bhl_stats.Progress('items and TOC pages', len(todo))
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            for crnt_item, loaded in zip(todo, pool.map(load_pages, todo)):   # Get all BHL page level metadata for all items. Save in BHL_pages.
+                progress.step()
+                if not loaded:
+                    print('Unable to read BHL page level metadata for item',crnt_item)
+            if fname and todo:
+                BHL_pages.save(fname)
+            pageids = [(crnt_item, pageid) for crnt_item in itemids for pageid in BHL_pages.toc_pages(crnt_item)]
+            progress.add_total(len(pageids))
+            ocr = zip(pageids, pool.map(read_toc_BHL, [pageid for crnt_item, pageid in pageids]))
+            for crnt_item, texts in itertools.groupby(ocr, lambda crnt: crnt[0][0]):   # Parse the table of contents pages of each item in turn
+                art_list = []
+                for (crnt_item, pageid), text in texts:
+                    progress.step()
+                    art_list.extend(grammar.parse(text.splitlines(keepends=True)))
+                wrt_md(art_list, crnt_item)                 # All articles of the item at once, so end pages are inferred across TOC pages
+        progress.close()
+    elif itemid.startswith('d'):                            # Directory of OCR files?
+        files = toc_files(itemid[1:])
+        file_items = [crnt_item for crnt_item, fname in files]
+        fnames = [fname for crnt_item, fname in files]
+        itemids = sorted(set(file_items))
+        progress = bhl_stats.Progress('items and TOC files', len(itemids) + len(fnames))
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            for crnt_item, loaded in zip(itemids, pool.map(load_pages, itemids)):   # Get all BHL page level metadata for all items. Save in BHL_pages.
+                progress.step()
+                if not loaded:
+                    print('Unable to read BHL page level metadata for item',crnt_item)
+        parsed = zip(file_items, toc_grammar.parse_files(fnames, toc_grammar.get_grammar(grammar_name).name))
+        for crnt_item, files in itertools.groupby(parsed, lambda crnt: crnt[0]):   # Files are parsed in worker processes. Rows are written as each item is done.
+            art_list = []
+            for crnt_item, (fname, articles) in files:
+                progress.step()
+                art_list.extend(articles)
+            wrt_md(art_list, crnt_item)
+        progress.close()
+    else:
+        if not load_pages(itemid):                          # Get all BHL page level metadata for the item id. Save in BHL_pages.
+            print('Unable to read BHL page level metadata for item.')
+            exit()
+        #print(BHL_pages)
+        fhand = open('TOC_OCR.txt')   # Open the file that contains the BHL OCR text for the table of contents.
+        art_list = list(toc_grammar.get_grammar(grammar_name).parse(fhand))   # List of metadata fields derived from the TOC. This includes author, title and starting page number.
+        fhand.close()
+        wrt_md(art_list, int(itemid))   # Write all article metadata to a tsv file. The file is formatted as expected by the BHL Create Segments function.
 
+    output_file.close()
+    bhl_cache.report()